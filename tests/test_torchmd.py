@@ -278,6 +278,69 @@ def getTorchMDSystem(mol, device, precision):
     return system
 
 
+def loadAlanineDipeptide(precision=torch.double, device="cpu"):
+    # Solvated alanine dipeptide with its periodic box
+    from moleculekit.molecule import Molecule
+    import os
+
+    testdir = os.path.join("test-data", "prod_alanine_dipeptide_amber")
+    mol = Molecule(os.path.join(testdir, "structure.prmtop"))
+    mol.read(os.path.join(testdir, "input.coor"))
+    mol.read(os.path.join(testdir, "input.xsc"))
+    struct = parmed.load_file(os.path.join(testdir, "structure.prmtop"))
+    prm = parmed.amber.AmberParameterSet().from_structure(struct)
+    ff = ForceField.create(mol, prm)
+    parameters = Parameters(ff, mol, precision=precision, device=device)
+    pos = torch.tensor(mol.coords[:, :, 0], dtype=precision, device=device)
+    box = torch.diag(torch.tensor(mol.box[:, 0], dtype=precision, device=device))
+    return parameters, pos, box
+
+
+def computeForces(forces, pos, box, explicit_forces=True, **kwargs):
+    # Energies and forces of all systems in `pos`, the forces are computed explicitly or with autograd
+    frc = torch.zeros_like(pos)
+    if not explicit_forces:
+        pos = pos.detach().requires_grad_(True)
+    Epot = forces.compute(pos, box, frc, explicit_forces=explicit_forces, **kwargs)
+    if kwargs.get("itstep") is not None:
+        Epot = Epot[0]
+    return np.array([float(ee) for ee in Epot]), frc.detach().cpu().numpy()
+
+
+def compareVerletRun(forces, reference, pos, box, explicit_forces, nsteps=12):
+    # Steps drifting positions through Verlet list rebuilds and reuses and compares `forces` with `reference` at
+    # every step. Returns the steps at which `forces` rebuilt its list
+    drift = torch.tensor([0.1, 0.05, 0.0], dtype=pos.dtype, device=pos.device)
+    generator = torch.Generator(device=pos.device).manual_seed(0)
+    rebuilds = []
+    neighborlist = None
+    for step in range(nsteps):
+        verlet = dict(itstep=step, reconstep=25, delt_r=1.0)
+        ref_Epot, ref_frc = computeForces(
+            reference, pos, box, explicit_forces, **verlet
+        )
+        Epot, frc = computeForces(forces, pos, box, explicit_forces, **verlet)
+        np.testing.assert_allclose(Epot, ref_Epot, atol=1e-8, err_msg=f"step {step}")
+        np.testing.assert_allclose(frc, ref_frc, atol=1e-8, err_msg=f"step {step}")
+        if forces.neighborlist is not neighborlist:
+            rebuilds.append(step)
+            neighborlist = forces.neighborlist
+        noise = torch.randn(
+            pos.shape, generator=generator, dtype=pos.dtype, device=pos.device
+        )
+        pos = pos + drift + 0.01 * noise
+    return rebuilds
+
+
+allTerms = [
+    "bonds",
+    "angles",
+    "dihedrals",
+    "impropers",
+    "1-4",
+    "electrostatics",
+    "lj",
+]
 forcesTMD = ["angles", "bonds", "dihedrals", "lj", "electrostatics"]
 forcesOMM = [
     "angle",
@@ -516,6 +579,368 @@ class _TestTorchMD(unittest.TestCase):
         Epot = [ee.detach().numpy() for ee in Epot]
         assert np.abs(Epot[0] + 1722.3567) < 1e-4 and np.abs(Epot[1] + 1722.3567) < 1e-4
 
+    def test_replica_batching(self):
+        # All replicas are evaluated in one flattened pass, which has to match computing every replica on its own
+        parameters, pos, box = loadAlanineDipeptide()
+        torch.manual_seed(0)
+        for nsystems in (2, 3):
+            spos = pos + 0.05 * torch.randn((nsystems,) + pos.shape, dtype=pos.dtype)
+            sbox = box.repeat(nsystems, 1, 1)
+            for cutoff in (None, 9):
+                nonbonded = {} if cutoff is None else dict(switch_dist=7.5, rfa=True)
+                for explicit_forces in (True, False):
+                    with self.subTest(
+                        nsystems=nsystems,
+                        cutoff=cutoff,
+                        explicit_forces=explicit_forces,
+                    ):
+                        forces = Forces(
+                            parameters, terms=allTerms, cutoff=cutoff, **nonbonded
+                        )
+                        Epot, frc = computeForces(forces, spos, sbox, explicit_forces)
+                        assert Epot.shape == (nsystems,)
+                        for i in range(nsystems):
+                            single = Forces(
+                                parameters, terms=allTerms, cutoff=cutoff, **nonbonded
+                            )
+                            ref_Epot, ref_frc = computeForces(
+                                single,
+                                spos[i : i + 1],
+                                sbox[i : i + 1],
+                                explicit_forces,
+                            )
+                            np.testing.assert_allclose(Epot[i], ref_Epot[0], atol=1e-8)
+                            np.testing.assert_allclose(frc[i], ref_frc[0], atol=1e-8)
+
+    def test_pair_chunks(self):
+        # Pair lists longer than _max_pairs are evaluated in chunks and slices, which have to add up to the result of
+        # evaluating the whole list at once
+        parameters, pos, box = loadAlanineDipeptide()
+        torch.manual_seed(0)
+        for nsystems in (1, 2):
+            spos = pos + 0.05 * torch.randn((nsystems,) + pos.shape, dtype=pos.dtype)
+            sbox = box.repeat(nsystems, 1, 1)
+            for cutoff in (None, 9):
+                nonbonded = {} if cutoff is None else dict(switch_dist=7.5, rfa=True)
+                for explicit_forces in (True, False):
+                    with self.subTest(
+                        nsystems=nsystems,
+                        cutoff=cutoff,
+                        explicit_forces=explicit_forces,
+                    ):
+                        whole = Forces(
+                            parameters, terms=allTerms, cutoff=cutoff, **nonbonded
+                        )
+                        chunked = Forces(
+                            parameters, terms=allTerms, cutoff=cutoff, **nonbonded
+                        )
+                        # Not a divisor of the list lengths so that the last chunk is a partial one
+                        chunked._max_pairs = 10007
+                        ref_Epot, ref_frc = computeForces(
+                            whole, spos, sbox, explicit_forces
+                        )
+                        Epot, frc = computeForces(chunked, spos, sbox, explicit_forces)
+                        np.testing.assert_allclose(Epot, ref_Epot, atol=1e-8)
+                        np.testing.assert_allclose(frc, ref_frc, atol=1e-8)
+
+    def test_repulsion_forces(self):
+        # The explicit repulsion forces have to match the gradient of the repulsion energy
+        parameters, pos, box = loadAlanineDipeptide()
+        pos, box = pos.unsqueeze(0), box.unsqueeze(0)
+        for term in ("repulsion", "repulsioncg"):
+            for cutoff in (None, 9):
+                with self.subTest(term=term, cutoff=cutoff):
+                    forces = Forces(parameters, terms=[term], cutoff=cutoff)
+                    Epot, frc = computeForces(forces, pos, box)
+                    grad_Epot, grad_frc = computeForces(
+                        forces, pos, box, explicit_forces=False
+                    )
+                    assert np.all(np.isfinite(grad_frc))
+                    np.testing.assert_allclose(Epot, grad_Epot, rtol=1e-10)
+                    np.testing.assert_allclose(frc, grad_frc, rtol=1e-8, atol=1e-8)
+
+    def test_verlet_list(self):
+        # The Verlet list is reused until reconstep steps passed or an atom moved more than half the skin, at every
+        # step it has to give the same results as a fresh cell list search
+        parameters, pos, box = loadAlanineDipeptide()
+        pos, box = pos.unsqueeze(0), box.unsqueeze(0)
+        nonbonded = dict(cutoff=9, switch_dist=7.5, rfa=True)
+        verlet = Forces(parameters, terms=allTerms, **nonbonded)
+        fresh = Forces(parameters, terms=allTerms, **nonbonded)
+        reconstep = 25
+        # The drift of all atoms exceeds half the skin after a few steps, the noise changes their neighbours
+        drift = torch.tensor([0.1, 0.05, 0.0], dtype=pos.dtype)
+        torch.manual_seed(0)
+        rebuilds = []
+        neighborlist = None
+        for step in range(40):
+            Epot, frc = computeForces(
+                verlet, pos, box, itstep=step, reconstep=reconstep, delt_r=1.0
+            )
+            if verlet.neighborlist is not neighborlist:
+                rebuilds.append(step)
+                neighborlist = verlet.neighborlist
+            ref_Epot, ref_frc = computeForces(fresh, pos, box)
+            np.testing.assert_allclose(Epot, ref_Epot, atol=1e-8)
+            np.testing.assert_allclose(frc, ref_frc, atol=1e-8)
+            pos = pos + drift + 0.01 * torch.randn_like(pos)
+        assert 0 in rebuilds and reconstep in rebuilds
+        # Rebuilds triggered by the skin
+        assert any(step % reconstep for step in rebuilds)
+        assert len(rebuilds) < 40
+
+    def test_nonbonded_terms(self):
+        from torchmd.forces import evaluate_nonbonded
+
+        # Direct callers passing a term which is not non-bonded get an error instead of misaligned energy columns
+        dist = torch.ones(1, dtype=torch.double)
+        pairs = torch.tensor([[0, 1]], dtype=torch.int32)
+        for terms in (("bonds",), ("lj", "unknown")):
+            with self.subTest(terms=terms):
+                with self.assertRaises(ValueError):
+                    evaluate_nonbonded(
+                        dist, pairs, None, 1, terms, None, None, None, None
+                    )
+
+    def test_collinear_torsions(self):
+        from torchmd.forces import evaluate_torsion
+        from math import cos, sin
+
+        # Collinear atoms leave the dihedral undefined, it is evaluated at phi = 0 with finite forces
+        r12 = torch.tensor([[1.0, 0.0, 0.0], [1.0, 0.0, 0.0]], dtype=torch.double)
+        r23 = torch.tensor([[1.0, 0.0, 0.0], [1.0, 0.0, 0.0]], dtype=torch.double)
+        r34 = torch.tensor([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]], dtype=torch.double)
+        idx = torch.tensor([0, 1])
+        k0, phi0 = 1.5, 0.3
+        amber = {
+            "idx": idx,
+            "params": torch.tensor([[k0, phi0, 2.0]] * 2, dtype=torch.double),
+            "amber": True,
+        }
+        # Integer periodicities are evaluated by angle addition instead of atan2
+        amber_powers = dict(
+            amber,
+            max_per=2,
+            per_idx=torch.tensor([1, 1]),
+            cos_phi0=torch.full((2,), cos(phi0), dtype=torch.double),
+            sin_phi0=torch.full((2,), sin(phi0), dtype=torch.double),
+        )
+        charmm = {
+            "idx": idx,
+            "params": torch.tensor([[k0, phi0, 0.0]] * 2, dtype=torch.double),
+            "amber": False,
+        }
+        for name, table, energy in (
+            ("amber", amber, k0 * (1 + cos(phi0))),
+            ("amber_powers", amber_powers, k0 * (1 + cos(phi0))),
+            ("charmm", charmm, k0 * phi0 ** 2),
+        ):
+            with self.subTest(torsion=name):
+                pot, forces = evaluate_torsion(r12, r23, r34, [table])
+                np.testing.assert_allclose(pot.numpy(), [energy, energy])
+                for frc in forces:
+                    assert torch.all(torch.isfinite(frc))
+
+    def test_mixed_precision(self):
+        # Only the unit vectors of the pairs are rounded to bfloat16, so on every path the energies match full
+        # precision and the forces stay close to it
+        parameters, pos, box = loadAlanineDipeptide()
+        pos, box = pos.unsqueeze(0), box.unsqueeze(0)
+        # All-pairs list, cell list search and a Verlet list built at step 0 and reused at step 1
+        for cutoff, steps in ((None, (None,)), (9, (None,)), (9, (0, 1))):
+            nonbonded = {} if cutoff is None else dict(switch_dist=7.5, rfa=True)
+            full = Forces(parameters, terms=allTerms, cutoff=cutoff, **nonbonded)
+            mixed = Forces(
+                parameters,
+                terms=allTerms,
+                cutoff=cutoff,
+                mixed_precision=True,
+                **nonbonded,
+            )
+            for itstep in steps:
+                with self.subTest(cutoff=cutoff, itstep=itstep):
+                    ref_Epot, ref_frc = computeForces(full, pos, box, itstep=itstep)
+                    Epot, frc = computeForces(mixed, pos, box, itstep=itstep)
+                    np.testing.assert_allclose(Epot, ref_Epot, rtol=1e-10)
+                    error = np.abs(frc - ref_frc).max()
+                    assert 0 < error <= 1e-2 * np.abs(ref_frc).max()
+
+    def test_pair_file(self):
+        from unittest import mock
+        import tempfile
+        import os
+
+        # Pairs which fit neither in device nor in host memory are written to an HDF5 file and streamed in chunks
+        devices = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+        for device in devices:
+            parameters, pos, box = loadAlanineDipeptide(device=device)
+            pos, box = pos.unsqueeze(0), box.unsqueeze(0)
+            in_memory = Forces(parameters, terms=allTerms)
+            cwd = os.getcwd()
+            with tempfile.TemporaryDirectory() as tmpdir:
+                os.chdir(tmpdir)
+                try:
+                    with mock.patch(
+                        "torchmd.forces._all_pairs", side_effect=MemoryError
+                    ):
+                        streamed = Forces(parameters, terms=allTerms)
+                    assert streamed.ava_idx is None
+                    assert os.path.exists("non-interactions.h5")
+                    streamed._max_pairs = 20000
+                    for explicit_forces in (True, False):
+                        with self.subTest(
+                            device=device, explicit_forces=explicit_forces
+                        ):
+                            ref_Epot, ref_frc = computeForces(
+                                in_memory, pos, box, explicit_forces
+                            )
+                            Epot, frc = computeForces(
+                                streamed, pos, box, explicit_forces
+                            )
+                            np.testing.assert_allclose(Epot, ref_Epot, atol=1e-8)
+                            np.testing.assert_allclose(frc, ref_frc, atol=1e-8)
+                    streamed.close()
+                finally:
+                    os.chdir(cwd)
+
+    def test_compile(self):
+        # The compiled distances, bonded and non-bonded terms and force scatter have to match the eager evaluation
+        # on the all-pairs list, the cell list search and the Verlet list
+        parameters, pos, box = loadAlanineDipeptide()
+        pos, box = pos.unsqueeze(0), box.unsqueeze(0)
+        for explicit_forces in (True, False):
+            for cutoff in (None, 9):
+                nonbonded = {} if cutoff is None else dict(switch_dist=7.5, rfa=True)
+                with self.subTest(explicit_forces=explicit_forces, cutoff=cutoff):
+                    eager = Forces(
+                        parameters, terms=allTerms, cutoff=cutoff, **nonbonded
+                    )
+                    compiled = Forces(
+                        parameters,
+                        terms=allTerms,
+                        cutoff=cutoff,
+                        compile=True,
+                        **nonbonded,
+                    )
+                    ref_Epot, ref_frc = computeForces(eager, pos, box, explicit_forces)
+                    Epot, frc = computeForces(compiled, pos, box, explicit_forces)
+                    np.testing.assert_allclose(Epot, ref_Epot, atol=1e-8)
+                    np.testing.assert_allclose(frc, ref_frc, atol=1e-8)
+            with self.subTest(explicit_forces=explicit_forces, verlet=True):
+                nonbonded = dict(cutoff=9, switch_dist=7.5, rfa=True)
+                eager = Forces(parameters, terms=allTerms, **nonbonded)
+                compiled = Forces(parameters, terms=allTerms, compile=True, **nonbonded)
+                rebuilds = compareVerletRun(
+                    compiled, eager, pos, box, explicit_forces
+                )
+                assert len(rebuilds) > 1 and len(rebuilds) < 12
+
+    def test_compile_reduce_overhead(self):
+        from unittest import mock
+
+        # With "reduce-overhead" the Verlet list keeps its shape between rebuilds and the pairs beyond the cutoff are
+        # masked, through the rebuilds and reuses of a run it has to match the eager evaluation
+        parameters, pos, box = loadAlanineDipeptide()
+        pos, box = pos.unsqueeze(0), box.unsqueeze(0)
+        nonbonded = dict(cutoff=9, switch_dist=7.5, rfa=True)
+        for explicit_forces in (True, False):
+            with self.subTest(explicit_forces=explicit_forces):
+                eager = Forces(parameters, terms=allTerms, **nonbonded)
+                compiled = Forces(
+                    parameters,
+                    terms=allTerms,
+                    compile="reduce-overhead",
+                    **nonbonded,
+                )
+                # Every call of compute starts a new step of the CUDA graphs
+                mark_step = mock.Mock(wraps=torch.compiler.cudagraph_mark_step_begin)
+                with mock.patch.object(
+                    torch.compiler, "cudagraph_mark_step_begin", mark_step
+                ):
+                    rebuilds = compareVerletRun(
+                        compiled, eager, pos, box, explicit_forces
+                    )
+                assert mark_step.call_count == 12
+                # Rebuilt by the skin check as well as reused in between
+                assert len(rebuilds) > 1 and len(rebuilds) < 12
+
+    def test_pair_file_reuse(self):
+        from unittest import mock
+        import tables
+        import tempfile
+        import os
+
+        # The pair file is only reused for the same number of atoms and exclusions, otherwise it is replaced
+        parameters, pos, box = loadAlanineDipeptide()
+        pos, box = pos.unsqueeze(0), box.unsqueeze(0)
+        default, bonded = ("bonds", "angles", "1-4"), ("bonds", "angles")
+
+        def streamed(exclusions):
+            with mock.patch("torchmd.forces._all_pairs", side_effect=MemoryError):
+                forces = Forces(parameters, terms=allTerms, exclusions=exclusions)
+            return forces, os.stat("non-interactions.h5").st_ino
+
+        def check(forces, exclusions):
+            in_memory = Forces(parameters, terms=allTerms, exclusions=exclusions)
+            ref_Epot, ref_frc = computeForces(in_memory, pos, box)
+            Epot, frc = computeForces(forces, pos, box)
+            np.testing.assert_allclose(Epot, ref_Epot, atol=1e-8)
+            np.testing.assert_allclose(frc, ref_frc, atol=1e-8)
+
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.chdir(tmpdir)
+            try:
+                first, first_file = streamed(default)
+                # Other exclusions replace the file, the first Forces keeps reading the one it opened
+                second, second_file = streamed(bonded)
+                assert second_file != first_file
+                check(first, default)
+                check(second, bonded)
+                # The same system reuses the file
+                third, third_file = streamed(bonded)
+                assert third_file == second_file
+                check(third, bonded)
+                for forces in (first, second, third):
+                    forces.close()
+
+                # A file with the right number of pairs written for other exclusions is replaced as well
+                with tables.open_file("non-interactions.h5", "a") as ffile:
+                    ffile.root.data.attrs.exclusions = "other"
+                fourth, fourth_file = streamed(bonded)
+                assert fourth_file != third_file
+                check(fourth, bonded)
+                fourth.close()
+            finally:
+                os.chdir(cwd)
+
+    def test_cell_list(self):
+        from torchmd.neighbourlist import CellList
+        from torchmd.forces import calculate_distances
+
+        torch.manual_seed(0)
+        natoms = 300
+        cutoff = 4.5
+        exclusions = [[0, 1], [5, 2], [10, 11]]
+        for box in (
+            torch.tensor([20.0, 25.0, 9.5]),
+            torch.tensor([20.0, 9.5, 0.0]),
+            torch.zeros(3),
+        ):
+            pos = torch.rand(natoms, 3) * 20
+            ii, jj = torch.triu_indices(natoms, natoms, 1)
+            allpairs = torch.stack((ii, jj), dim=1)
+            dist, _, _ = calculate_distances(pos, allpairs, box)
+            ref = {tuple(p) for p in allpairs[dist <= cutoff].tolist()}
+            ref -= {tuple(sorted(p)) for p in exclusions}
+
+            pairs, nl_dist, _ = CellList(natoms, exclusions, "cpu").build(
+                pos, box, cutoff
+            )
+            assert {tuple(p) for p in pairs.tolist()} == ref
+            assert len(pairs) == len(ref)
+            assert torch.all(nl_dist <= cutoff)
+
     # def test_cg(self):
     #     from torchmd.run import get_args, setup
 
@@ -3,7 +3,19 @@ import torch
 import numpy as np
 from math import pi
 import os
+import hashlib
+import tempfile
+from types import SimpleNamespace
 import tables as t
+from torchmd.neighbourlist import CellList
+from torchmd.pbc import calculate_distances, inverse_box, wrap_dist
+
+MAX_PAIRS = 2 ** 24
+# Number of pairs generated at once when building an all-pairs list
+PAIR_BLOCK = 2 ** 22
+# Approximate number of floating point values held in memory per pair while evaluating a chunk
+# (distances, vectors, energies, force coefficients and the scattered forces)
+PAIR_VALUES = 32
 
 
 class Forces:
@@ -19,6 +31,20 @@ class Forces:
         dielectric.
     solventDielectric : float
         Used together with `cutoff` and `rfa`
+    compile : bool or str
+        Compile the pair distances, the evaluation of the bonded and non-bonded terms and the scatter of the pair
+        forces with `torch.compile` (requires PyTorch 2.0, or 2.1 for "reduce-overhead") to fuse their many small
+        kernels. The first call will be slow as it triggers the compilation. A string is passed as the compilation
+        mode. With "reduce-overhead" the Verlet list keeps its shape between rebuilds by masking the pairs beyond the
+        cutoff instead of dropping them, so that the evaluation is replayed as a CUDA graph, and each call of
+        `compute` is marked as a new step of the CUDA graphs.
+    check_nan : bool
+        Raise an error if the positions passed to `compute` contain NaN or infinite values. The check synchronizes
+        with the device on every call so it is disabled by default.
+    mixed_precision : bool
+        Store the unit vectors of the non-bonded pairs in bfloat16 to halve the memory traffic of the force scatter.
+        Distances, bonded terms, energies and forces stay in the precision of the system. This trades accuracy for
+        speed and should not be used where energy conservation matters.
     """
 
     # 1-4 is nonbonded but we put it currently in bonded to not calculate all distances
@@ -36,6 +62,9 @@ class Forces:
         solventDielectric=78.5,
         switch_dist=None,
         exclusions=("bonds", "angles", "1-4"),
+        compile=False,
+        check_nan=False,
+        mixed_precision=False,
     ):
         self.par = parameters
         if terms is None:
@@ -44,6 +73,7 @@ class Forces:
             )
 
         self.energies = [ene.lower() for ene in terms]
+        self._term_ids = {v: j for j, v in enumerate(self.energies + ["external"])}
         for et in self.energies:
             if et not in Forces.terms:
                 raise ValueError(f"Force term {et} is not implemented.")
@@ -55,1162 +85,948 @@ class Forces:
 
         self.natoms = len(parameters.masses)
         self.require_distances = any(f in self.nonbonded for f in self.energies)
+        # With a cutoff the neighbours are found with a cell list, otherwise all pairs are needed
         self.ava_idx = (
             self._make_indeces(
                 self.natoms, parameters.get_exclusions(exclusions), parameters.device
             )
-            if self.require_distances
+            if self.require_distances and cutoff is None
+            else None
+        )
+        # Pairs that did not fit in memory were written to disk by _make_indeces, keep the file open for all steps.
+        # It is closed by close()
+        self._pair_file = (
+            t.open_file("non-interactions.h5", "r")
+            if self.require_distances and cutoff is None and self.ava_idx is None
+            else None
+        )
+        # All-pairs lists are evaluated in chunks of _max_pairs, a single one if the whole list fits. The pairs are
+        # read from the pair file, or from the pair list which may have been left in host memory
+        self._chunk_source = None
+        host_pairs = False
+        if self._pair_file is not None:
+            self._chunk_source = self._pair_file.root.data
+            host_pairs = True
+        elif self.ava_idx is not None:
+            host_pairs = not self.ava_idx.is_cuda
+            if host_pairs and torch.device(parameters.device).type == "cuda":
+                # Pinned row-major so that every chunk sliced off it is contiguous pinned memory, which can be copied
+                # without staging. offset_pairs gives the chunks the column-major layout again on the device
+                self.ava_idx = self.ava_idx.contiguous().pin_memory()
+            self._chunk_source = self.ava_idx
+        # Host pairs are copied to the GPU on a side stream so that the copies overlap with the evaluation
+        self._copy_stream = (
+            torch.cuda.Stream(device=parameters.device)
+            if host_pairs and torch.device(parameters.device).type == "cuda"
+            else None
+        )
+        self.cell_list = (
+            CellList(
+                self.natoms, parameters.get_exclusions(exclusions), parameters.device
+            )
+            if self.require_distances and cutoff is not None
             else None
         )
+        # Fixed number of pairs evaluated at once when going through an all-pairs list
+        self._max_pairs = self._pair_chunk_size(parameters.device)
         self.neighborlist = None
+        self._neighbor_systems = None
+        self._neighbor_lj = None
+        self._neighbor_elec = None
+        self._ref_pos = None
+        self._replicas = None
+        self._energy_buf = None
+        self._bonded_pairs, self._bonded_slices = self._make_bonded_pairs()
+        self._bonded_fn = evaluate_bonded
+        self._nonbonded_fn = evaluate_nonbonded
+        self._distances_fn = calculate_distances
+        self._scatter_fn = scatter_pair_forces
+        if compile:
+            mode = compile if isinstance(compile, str) else None
+            self._bonded_fn = torch.compile(evaluate_bonded, dynamic=True, mode=mode)
+            self._nonbonded_fn = torch.compile(
+                evaluate_nonbonded, dynamic=True, mode=mode
+            )
+            self._distances_fn = torch.compile(
+                calculate_distances, dynamic=True, mode=mode
+            )
+            self._scatter_fn = torch.compile(
+                scatter_pair_forces, dynamic=True, mode=mode
+            )
+        self._static_pairs = compile == "reduce-overhead"
+        if self._static_pairs and not hasattr(
+            getattr(torch, "compiler", None), "cudagraph_mark_step_begin"
+        ):
+            raise RuntimeError(
+                'compile="reduce-overhead" requires PyTorch 2.1 or newer for torch.compiler.cudagraph_mark_step_begin.'
+            )
         self.external = external
         self.cutoff = cutoff
         self.rfa = rfa
         self.solventDielectric = solventDielectric
         self.switch_dist = switch_dist
+        self.check_nan = check_nan
+        self._pair_dtype = torch.bfloat16 if mixed_precision else None
+        self._nonbonded_terms = tuple(v for v in self.energies if v in self.nonbonded)
+        self._nonbonded_cols = torch.tensor(
+            [self._term_ids[v] for v in self._nonbonded_terms],
+            dtype=torch.long,
+            device=parameters.device,
+        )
+
+    def _pair_chunk_size(self, device):
+        # Size the pair chunks once from the free GPU memory instead of probing it at every step
+        device = torch.device(device)
+        if device.type != "cuda":
+            return MAX_PAIRS
+        free, _ = torch.cuda.mem_get_info(device)
+        pair_bytes = PAIR_VALUES * self.par.A.element_size()
+        return max(1, min(MAX_PAIRS, int(free * 0.8 / pair_bytes)))
+
+    def _make_bonded_pairs(self):
+        # All atom pairs needed by the bonded terms so that their distances are computed in a single call
+        par = self.par
+        terms = []
+        if "bonds" in self.energies and par.bonds is not None:
+            terms.append(("bonds", par.bonds))
+        if "angles" in self.energies and par.angles is not None:
+            terms.append(("angles_21", par.angles[:, [0, 1]]))
+            terms.append(("angles_23", par.angles[:, [2, 1]]))
+        if "dihedrals" in self.energies and par.dihedrals is not None:
+            terms.append(("dihedrals_12", par.dihedrals[:, [0, 1]]))
+            terms.append(("dihedrals_23", par.dihedrals[:, [1, 2]]))
+            terms.append(("dihedrals_34", par.dihedrals[:, [2, 3]]))
+        if "1-4" in self.energies and par.idx14 is not None:
+            terms.append(("1-4", par.idx14))
+        if "impropers" in self.energies and par.impropers is not None:
+            terms.append(("impropers_12", par.impropers[:, [0, 1]]))
+            terms.append(("impropers_23", par.impropers[:, [1, 2]]))
+            terms.append(("impropers_34", par.impropers[:, [2, 3]]))
+
+        slices = {}
+        start = 0
+        for name, idx in terms:
+            slices[name] = slice(start, start + len(idx))
+            start += len(idx)
+        if len(terms) == 0:
+            return None, slices
+        return torch.cat([idx for _, idx in terms], dim=0).contiguous(), slices
+
+    def _replicate(self, nsystems):
+        # Parameters and pairs of all systems with the atom indexes offset into the flattened positions.
+        # The (N, k) tables are stored column-major so that every arr[:, k] read by the evaluators is contiguous.
+        if self._replicas is not None and self._replicas.nsystems == nsystems:
+            return self._replicas
+
+        par = self.par
+        device = par.charges.device
+        offsets = torch.arange(nsystems, device=device, dtype=torch.int32) * self.natoms
+
+        def offset(idx):
+            if idx is None:
+                return None
+            cols = idx.T.to(torch.int32).unsqueeze(1) + offsets.view(1, -1, 1)
+            return cols.reshape(idx.shape[1], -1).T
+
+        def repeat(arr):
+            if arr is None:
+                return None
+            if arr.dim() == 1:
+                return arr.repeat(nsystems)
+            return arr.T.repeat(1, nsystems).T
+
+        def torsions(torsion_params, ntorsions):
+            # All Fourier terms are merged into a single table so that every torsion type needs a single pass.
+            # "amber" is a bool if all terms are of one kind, otherwise a mask of the AMBER terms
+            if torsion_params is None:
+                return None
+            steps = torch.arange(nsystems, device=device) * ntorsions
+            idx = torch.cat(
+                [
+                    (tp["idx"].unsqueeze(0) + steps[:, None]).reshape(-1)
+                    for tp in torsion_params
+                ]
+            )
+            params = torch.cat(
+                [repeat(tp["params"]).T for tp in torsion_params], dim=1
+            ).T
+            per = params[:, 2]
+            amber = per > 0
+            if bool(torch.all(amber)):
+                amber = True
+            elif not bool(torch.any(amber)):
+                amber = False
+            table = {"idx": idx, "params": params, "amber": amber}
+            if amber is True and len(per) and bool(torch.all(per == torch.round(per))):
+                # Integer periodicities allow evaluating the AMBER terms without atan2, see _amber_torsion_powers
+                table["max_per"] = int(per.max())
+                table["per_idx"] = per.long() - 1
+                table["cos_phi0"] = torch.cos(params[:, 1])
+                table["sin_phi0"] = torch.sin(params[:, 1])
+            return [table]
+
+        rpar = SimpleNamespace(
+            bonds=offset(par.bonds),
+            bond_params=repeat(par.bond_params),
+            angles=offset(par.angles),
+            angle_params=repeat(par.angle_params),
+            dihedrals=offset(par.dihedrals),
+            dihedral_params=torsions(
+                par.dihedral_params, 0 if par.dihedrals is None else len(par.dihedrals)
+            ),
+            idx14=offset(par.idx14),
+            nonbonded_14_params=repeat(par.nonbonded_14_params),
+            impropers=offset(par.impropers),
+            improper_params=torsions(
+                par.improper_params, 0 if par.impropers is None else len(par.impropers)
+            ),
+            charges=repeat(par.charges),
+            mapped_atom_types=repeat(par.mapped_atom_types),
+        )
+
+        # Keep the pairs of each bonded term contiguous over all systems
+        bonded_pairs, bonded_slices = None, {}
+        if self._bonded_pairs is not None:
+            bonded_pairs = torch.cat(
+                [
+                    offset(self._bonded_pairs[sl]).T
+                    for sl in self._bonded_slices.values()
+                ],
+                dim=1,
+            ).T
+            bonded_slices = {
+                name: slice(sl.start * nsystems, sl.stop * nsystems)
+                for name, sl in self._bonded_slices.items()
+            }
+
+        atom_systems = torch.arange(nsystems, device=device).repeat_interleave(
+            self.natoms
+        )
+        self._replicas = SimpleNamespace(
+            nsystems=nsystems,
+            par=rpar,
+            atom_systems=atom_systems,
+            bonded_pairs=bonded_pairs,
+            bonded_slices=bonded_slices,
+            bonded_systems=None
+            if bonded_pairs is None
+            else atom_systems[bonded_pairs[:, 0]],
+            offset_pairs=offset,
+            # All-pairs list with its systems and pair constants, cached if it fits in a single chunk
+            all_pairs=None,
+            # Arguments of evaluate_nonbonded which stay the same for every chunk and step
+            nonbonded_args=(
+                self._nonbonded_terms,
+                rpar.charges,
+                rpar.mapped_atom_types,
+                self.par.A,
+                self.par.B,
+                self.cutoff,
+                self.rfa,
+                self.solventDielectric,
+                self.switch_dist,
+            ),
+        )
+        return self._replicas
+
+    def _build_neighbours(self, pos, sboxes, nsystems, delt_r=0):
+        # Cell list search of every system with the pairs offset into the flattened positions
+        if nsystems == 1:
+            pairs, dist, unitvec = self.cell_list.build(
+                pos, sboxes[0], self.cutoff, delt_r
+            )
+            return (pairs,) + self._pair_precision(dist, unitvec)
+        pairs, dist, unitvec = [], [], []
+        for i in range(nsystems):
+            start = i * self.natoms
+            p, d, u = self.cell_list.build(
+                pos[start : start + self.natoms], sboxes[i], self.cutoff, delt_r
+            )
+            pairs.append(p + start)
+            dist.append(d)
+            unitvec.append(u)
+        pairs = torch.cat([p.T for p in pairs], dim=1).T
+        return (pairs,) + self._pair_precision(torch.cat(dist), torch.cat(unitvec))
+
+    def _skin_exceeded(self, pos, delt_r):
+        # The Verlet list stays valid until some atom moved more than half the skin since it was built
+        if self.neighborlist is None or self._ref_pos is None:
+            return False
+        if self._ref_pos.shape != pos.shape:
+            return True
+        disp2 = torch.sum((pos.detach() - self._ref_pos) ** 2, dim=1)
+        return bool(torch.max(disp2) > (delt_r / 2) ** 2)
+
+    def _energy_table(self, nsystems, pos, explicit_forces):
+        # With explicit forces the energies only leave compute as Python floats so the same table is reused at every
+        # step, with autograd every step needs its own table for the graph
+        shape = (nsystems, len(self._term_ids))
+        if not explicit_forces:
+            return torch.zeros(shape, device=pos.device, dtype=pos.dtype)
+        buf = self._energy_buf
+        if (
+            buf is None
+            or buf.shape != shape
+            or buf.device != pos.device
+            or buf.dtype != pos.dtype
+        ):
+            self._energy_buf = torch.zeros(shape, device=pos.device, dtype=pos.dtype)
+            return self._energy_buf
+        return buf.zero_()
+
+    def _pair_systems(self, pairs):
+        # System each pair belongs to, not needed with a single system
+        if self._replicas.nsystems == 1:
+            return None
+        return self._replicas.atom_systems[pairs[:, 0]]
+
+    def _system_boxes(self, sboxes, systems):
+        # Box and reciprocal box of every pair given the `systems` of the pairs. The reciprocal boxes are computed
+        # per system and gathered along with the boxes so that no pair needs a division
+        inv_boxes = inverse_box(sboxes)
+        if systems is None:
+            return sboxes[0], inv_boxes[0]
+        return sboxes[systems], inv_boxes[systems]
+
+    def _pair_distances(self, pos, pairs, sboxes, systems):
+        # Distances of pairs over all systems, each one wrapped in the box of its own system
+        box, inv_box = self._system_boxes(sboxes, systems)
+        dist, unitvec, vec = self._distances_fn(pos, pairs, box, inv_box)
+        return self._pair_precision(dist, unitvec) + (vec,)
+
+    def _pair_precision(self, dist, unitvec):
+        # With mixed_precision the unit vectors are stored in bfloat16 and promoted back when scattering the forces.
+        # Distances stay in full precision as the steep short-range terms amplify any rounding of them
+        if self._pair_dtype is None:
+            return dist, unitvec
+        return dist, unitvec.to(self._pair_dtype)
+
+    def _to_device(self, pairs):
+        # Chunks of pairs kept on the host are copied from pinned memory on the copy stream, the compute stream
+        # only waits for the copy once it reaches the kernels that use the chunk
+        if isinstance(pairs, np.ndarray):
+            pairs = torch.from_numpy(pairs.astype(np.int32))
+        if pairs.is_cuda or self._copy_stream is None:
+            return pairs.to(self.par.device)
+        if not (pairs.is_pinned() and pairs.is_contiguous()):
+            # A non-contiguous view of pinned memory would be staged through a pageable copy by the non-blocking copy
+            pairs = pairs.contiguous().pin_memory()
+        with torch.cuda.stream(self._copy_stream):
+            pairs = pairs.to(self.par.device, non_blocking=True)
+        compute_stream = torch.cuda.current_stream(pairs.device)
+        compute_stream.wait_stream(self._copy_stream)
+        pairs.record_stream(compute_stream)
+        return pairs
+
+    def _evaluate_pairs(
+        self,
+        pot,
+        forces,
+        pairs,
+        systems,
+        dist,
+        unitvec,
+        explicit_forces,
+        within=None,
+        lj_params=None,
+        elec_factors=None,
+    ):
+        # Non-bonded energies and forces of the given pairs of the flattened systems, only of the pairs set in the
+        # mask `within` if given. Long neighbour lists are evaluated in slices of _max_pairs pairs so that the
+        # intermediates of the evaluation never exceed the size of one chunk
+        rep = self._replicas
+        for start in range(0, len(pairs), self._max_pairs):
+            sl = slice(start, start + self._max_pairs)
+            energies, force_coeff = self._nonbonded_fn(
+                dist[sl],
+                pairs[sl],
+                None if systems is None else systems[sl],
+                rep.nsystems,
+                *rep.nonbonded_args,
+                explicit_forces,
+                None if within is None else within[sl],
+                None if lj_params is None else lj_params[sl],
+                None if elec_factors is None else elec_factors[sl],
+            )
+            pot[:, self._nonbonded_cols] += energies
+            if explicit_forces:
+                self._scatter_fn(forces, pairs[sl], unitvec[sl], force_coeff)
+
+    def _evaluate_chunked(self, source, pos, sboxes, pot, forces, explicit_forces):
+        # Goes through an all-pairs list in fixed-size chunks, `source` is either the pair file or a tensor.
+        # The next chunk is fetched once the current one is queued so that its copy overlaps with the evaluation.
+        # Every pair of the list is replicated over all systems, which the chunk size accounts for
+        chunk = max(1, self._max_pairs // self._replicas.nsystems)
+        if self._pair_file is None and len(source) <= chunk:
+            self._evaluate_all_pairs(source, pos, sboxes, pot, forces, explicit_forces)
+            return
+        starts = range(0, len(source), chunk)
+        next_chunk = self._to_device(source[:chunk]) if len(starts) else None
+        for start in starts:
+            pairs = self._replicas.offset_pairs(next_chunk)
+            systems = self._pair_systems(pairs)
+            dist, unitvec, _ = self._pair_distances(pos, pairs, sboxes, systems)
+            self._evaluate_pairs(
+                pot, forces, pairs, systems, dist, unitvec, explicit_forces
+            )
+            del pairs, systems, dist, unitvec, next_chunk
+            end = start + chunk
+            if end < len(source):
+                next_chunk = self._to_device(source[end : end + chunk])
+
+    def _evaluate_all_pairs(self, source, pos, sboxes, pot, forces, explicit_forces):
+        # An all-pairs list which fits in one chunk is the same at every step, so it is offset and its systems and
+        # pair constants are looked up only once for the replicated systems
+        rep = self._replicas
+        if rep.all_pairs is None:
+            pairs = rep.offset_pairs(self._to_device(source))
+            rep.all_pairs = (pairs, self._pair_systems(pairs)) + self._pair_constants(
+                pairs
+            )
+        pairs, systems, lj_params, elec_factors = rep.all_pairs
+        dist, unitvec, _ = self._pair_distances(pos, pairs, sboxes, systems)
+        self._evaluate_pairs(
+            pot,
+            forces,
+            pairs,
+            systems,
+            dist,
+            unitvec,
+            explicit_forces,
+            lj_params=lj_params,
+            elec_factors=elec_factors,
+        )
 
     def _filter_by_cutoff(self, dist, arrays):
-        under_cutoff = dist <= self.cutoff
-        indexedarrays = []
-        for arr in arrays:
-            indexedarrays.append(arr[under_cutoff])
-        return indexedarrays
-    
-    def _neighbor_verlet_list(self, dist, arrays, delt_r):
-        neighbor = dist <= self.cutoff + delt_r
-        indexedarrays = []
-        for arr in arrays:
-            indexedarrays.append(arr[neighbor])
-        return indexedarrays
+        # The kept pairs are found once, indexing every array with the boolean mask would synchronize for each of them
+        kept = torch.nonzero(dist <= self.cutoff).squeeze(1)
+        return [None if arr is None else _select_pairs(arr, kept) for arr in arrays]
+
+    def _pair_constants(self, pairs):
+        # Per-pair constants looked up once per pair list: the (npairs, 2) column-major LJ A and B and the Coulomb
+        # factors of every pair, None for terms which are not evaluated
+        lj_params = elec_factors = None
+        if "lj" in self._nonbonded_terms:
+            aa, bb = _pair_params(
+                pairs, self._replicas.par.mapped_atom_types, self.par.A, self.par.B
+            )
+            lj_params = torch.stack((aa, bb)).T
+        if "electrostatics" in self._nonbonded_terms:
+            elec_factors = _coulomb_factors(pairs, self._replicas.par.charges)
+        return lj_params, elec_factors
 
     def compute(self, pos, box, forces, returnDetails=False, explicit_forces=True, itstep = None, reconstep = None, delt_r = None):
         #I plus three more values
         ## itstep: iteration step, the times of iteration, must start from 0.
-        ## reconstep: reconstruction step, after these steps, the verlet list need to reconstruct
-        ## delt_r: the delta radius out of the cutoff in order to consider enough molecules until reconstruction step.
+        ## reconstep: reconstruction step, after these steps at the latest, the verlet list need to reconstruct
+        ## delt_r: the delta radius out of the cutoff (the skin). The list is also rebuilt once an atom moved more than delt_r / 2.
         if not explicit_forces and not pos.requires_grad:
             raise RuntimeError(
                 "The positions passed don't require gradients. Please use pos.detach().requires_grad_(True) before passing."
             )
 
+        if self._static_pairs:
+            # Every call is one step of the CUDA graphs, the outputs of the graphs of the previous step are consumed
+            # by now and may be overwritten by the replays of this one
+            torch.compiler.cudagraph_mark_step_begin()
+
         nsystems = pos.shape[0]
-        if torch.any(torch.isnan(pos)):
+        if self.check_nan and not torch.isfinite(pos).all():
             raise RuntimeError("Found NaN coordinates.")
 
-        pot = []
-        for i in range(nsystems):
-            pp = {
-                v: torch.zeros(1, device=pos.device).type(pos.dtype)
-                for v in self.energies
-            }
-            pp["external"] = torch.zeros(1, device=pos.device).type(pos.dtype)
-            pot.append(pp)
+        # Energies of every system and term, the columns are given by self._term_ids
+        pot = self._energy_table(nsystems, pos, explicit_forces)
 
         forces.zero_()
-        for i in range(nsystems):
-            spos = pos[i]
-            sbox = box[i][torch.eye(3).bool()]  # Use only the diagonal
-
-            # Bonded terms
-            # TODO: We are for sure doing duplicate distance calculations here!
-            if "bonds" in self.energies and self.par.bonds is not None:
-                bond_dist, bond_unitvec, _ = calculate_distances(
-                    spos, self.par.bonds, sbox
-                )
-                pairs = self.par.bonds
-                bond_params = self.par.bond_params
-                if self.cutoff is not None:
-                    (
-                        bond_dist,
-                        bond_unitvec,
-                        pairs,
-                        bond_params,
-                    ) = self._filter_by_cutoff(
-                        bond_dist, (bond_dist, bond_unitvec, pairs, bond_params)
-                    )
-                E, force_coeff = evaluate_bonds(bond_dist, bond_params, explicit_forces)
-
-                pot[i]["bonds"] += E.sum()
-                if explicit_forces:
-                    forcevec = bond_unitvec * force_coeff[:, None]
-                    forces[i].index_add_(0, pairs[:, 0], -forcevec)
-                    forces[i].index_add_(0, pairs[:, 1], forcevec)
-
-            if "angles" in self.energies and self.par.angles is not None:
-                _, _, r21 = calculate_distances(spos, self.par.angles[:, [0, 1]], sbox)
-                _, _, r23 = calculate_distances(spos, self.par.angles[:, [2, 1]], sbox)
-                E, angle_forces = evaluate_angles(
-                    r21, r23, self.par.angle_params, explicit_forces
-                )
-
-                pot[i]["angles"] += E.sum()
-                if explicit_forces:
-                    forces[i].index_add_(0, self.par.angles[:, 0], angle_forces[0])
-                    forces[i].index_add_(0, self.par.angles[:, 1], angle_forces[1])
-                    forces[i].index_add_(0, self.par.angles[:, 2], angle_forces[2])
-
-            if "dihedrals" in self.energies and self.par.dihedrals is not None:
-                _, _, r12 = calculate_distances(
-                    spos, self.par.dihedrals[:, [0, 1]], sbox
-                )
-                _, _, r23 = calculate_distances(
-                    spos, self.par.dihedrals[:, [1, 2]], sbox
-                )
-                _, _, r34 = calculate_distances(
-                    spos, self.par.dihedrals[:, [2, 3]], sbox
-                )
-                E, dihedral_forces = evaluate_torsion(
-                    r12, r23, r34, self.par.dihedral_params, explicit_forces
-                )
-
-                pot[i]["dihedrals"] += E.sum()
-                if explicit_forces:
-                    forces[i].index_add_(
-                        0, self.par.dihedrals[:, 0], dihedral_forces[0]
-                    )
-                    forces[i].index_add_(
-                        0, self.par.dihedrals[:, 1], dihedral_forces[1]
-                    )
-                    forces[i].index_add_(
-                        0, self.par.dihedrals[:, 2], dihedral_forces[2]
-                    )
-                    forces[i].index_add_(
-                        0, self.par.dihedrals[:, 3], dihedral_forces[3]
+        # All systems are evaluated together on the flattened positions
+        rep = self._replicate(nsystems)
+        spos = pos.reshape(-1, 3)
+        sboxes = box.diagonal(dim1=-2, dim2=-1)  # Use only the diagonal
+        sforces = forces.view(-1, 3)
+
+        # Bonded terms
+        if self._bonded_pairs is not None:
+            bonded_box, bonded_inv_box = self._system_boxes(
+                sboxes, None if nsystems == 1 else rep.bonded_systems
+            )
+            bonded_ene, bonded_forces = self._bonded_fn(
+                spos,
+                bonded_box,
+                rep.par,
+                self.energies,
+                rep.bonded_pairs,
+                rep.bonded_slices,
+                self.cutoff,
+                nsystems,
+                explicit_forces,
+                bonded_inv_box,
+            )
+            for v, E in zip(BONDED_ENERGIES, bonded_ene):
+                if v in self._term_ids:
+                    pot[:, self._term_ids[v]] += E
+            if explicit_forces:
+                sforces += bonded_forces
+
+        # Non-bonded terms
+        if self.cell_list is not None:
+            if itstep is not None:
+                if reconstep is None:
+                    reconstep = 10  # reconstep is 10 by default
+                if reconstep <= 1:
+                    raise ValueError(" reconstep can not less than 2")
+                if delt_r is None:
+                    delt_r = self.cutoff
+                if itstep % reconstep == 0 or self._skin_exceeded(spos, delt_r):
+                    self.neighborlist, nbv_dist, nbv_unitvec = self._build_neighbours(
+                        spos, sboxes, nsystems, delt_r
                     )
-
-            if "1-4" in self.energies and self.par.idx14 is not None:
-                nb_dist, nb_unitvec, _ = calculate_distances(spos, self.par.idx14, sbox)
-
-                nonbonded_14_params = self.par.nonbonded_14_params
-                idx14 = self.par.idx14
-                # if self.cutoff is not None:
-                #     (
-                #         nb_dist,
-                #         nb_unitvec,
-                #         nonbonded_14_params,
-                #         idx14,
-                #     ) = self._filter_by_cutoff(
-                #         nb_dist,
-                #         (
-                #             nb_dist,
-                #             nb_unitvec,
-                #             self.par.nonbonded_14_params,
-                #             self.par.idx14,
-                #         ),
-                #     )
-
-                aa = nonbonded_14_params[:, 0]
-                bb = nonbonded_14_params[:, 1]
-                scnb = nonbonded_14_params[:, 2]
-                scee = nonbonded_14_params[:, 3]
-
-                if "lj" in self.energies:
-                    E, force_coeff = evaluate_LJ_internal(
-                        nb_dist, aa, bb, scnb, None, None, explicit_forces
+                    self._neighbor_systems = self._pair_systems(self.neighborlist)
+                    (
+                        self._neighbor_lj,
+                        self._neighbor_elec,
+                    ) = self._pair_constants(self.neighborlist)
+                    self._ref_pos = spos.detach().clone()
+                elif self.neighborlist is None:
+                    raise ValueError("itration step should start from 0")
+                else:
+                    nbv_dist, nbv_unitvec, _ = self._pair_distances(
+                        spos, self.neighborlist, sboxes, self._neighbor_systems
                     )
-                    pot[i]["lj"] += E.sum()
-                    if explicit_forces:
-                        forcevec = nb_unitvec * force_coeff[:, None]
-                        forces[i].index_add_(0, idx14[:, 0], -forcevec)
-                        forces[i].index_add_(0, idx14[:, 1], forcevec)
-                if "electrostatics" in self.energies:
-                    E, force_coeff = evaluate_electrostatics(
+                if self._static_pairs:
+                    # Keep the shape of the list until the next rebuild, pairs beyond the cutoff are masked
+                    ava_idx, systems = self.neighborlist, self._neighbor_systems
+                    nb_dist, nb_unitvec = nbv_dist, nbv_unitvec
+                    lj_params = self._neighbor_lj
+                    elec_factors = self._neighbor_elec
+                    within = nbv_dist <= self.cutoff
+                else:
+                    # The systems and pair constants of the listed pairs are kept from the last rebuild and filtered
+                    # along with them
+                    (
                         nb_dist,
-                        idx14,
-                        self.par.charges,
-                        scee,
-                        cutoff=None,
-                        rfa=False,
-                        solventDielectric=self.solventDielectric,
-                        explicit_forces=explicit_forces,
+                        nb_unitvec,
+                        ava_idx,
+                        systems,
+                        lj_params,
+                        elec_factors,
+                    ) = self._filter_by_cutoff(
+                        nbv_dist,
+                        (
+                            nbv_dist,
+                            nbv_unitvec,
+                            self.neighborlist,
+                            self._neighbor_systems,
+                            self._neighbor_lj,
+                            self._neighbor_elec,
+                        ),
                     )
-                    pot[i]["electrostatics"] += E.sum()
-                    if explicit_forces:
-                        forcevec = nb_unitvec * force_coeff[:, None]
-                        forces[i].index_add_(0, idx14[:, 0], -forcevec)
-                        forces[i].index_add_(0, idx14[:, 1], forcevec)
-                del aa, bb, scnb, scee, force_coeff
-
-            if "impropers" in self.energies and self.par.impropers is not None:
-                _, _, r12 = calculate_distances(
-                    spos, self.par.impropers[:, [0, 1]], sbox
-                )
-                _, _, r23 = calculate_distances(
-                    spos, self.par.impropers[:, [1, 2]], sbox
-                )
-                _, _, r34 = calculate_distances(
-                    spos, self.par.impropers[:, [2, 3]], sbox
-                )
-                E, improper_forces = evaluate_torsion(
-                    r12, r23, r34, self.par.improper_params, explicit_forces
+                    within = None
+            else:
+                ava_idx, nb_dist, nb_unitvec = self._build_neighbours(
+                    spos, sboxes, nsystems
                 )
+                systems = self._pair_systems(ava_idx)
+                lj_params = elec_factors = None
+                within = None
+            self._evaluate_pairs(
+                pot,
+                sforces,
+                ava_idx,
+                systems,
+                nb_dist,
+                nb_unitvec,
+                explicit_forces,
+                within,
+                lj_params,
+                elec_factors,
+            )
+        elif self._chunk_source is not None:
+            self._evaluate_chunked(
+                self._chunk_source, spos, sboxes, pot, sforces, explicit_forces
+            )
 
-                pot[i]["impropers"] += E.sum()
-                if explicit_forces:
-                    forces[i].index_add_(
-                        0, self.par.impropers[:, 0], improper_forces[0]
-                    )
-                    forces[i].index_add_(
-                        0, self.par.impropers[:, 1], improper_forces[1]
-                    )
-                    forces[i].index_add_(
-                        0, self.par.impropers[:, 2], improper_forces[2]
-                    )
-                    forces[i].index_add_(
-                        0, self.par.impropers[:, 3], improper_forces[3]
-                    )
-                del r12, r23, r34, E, improper_forces
-                torch.cuda.empty_cache()
-
-            # Non-bonded terms
-            if self.ava_idx == None:
-                ffile = t.open_file('non-interactions.h5', 'r')
-                idx = ffile.root.data
-                if self.require_distances and len(idx):
-                    import pynvml
-                    pynvml.nvmlInit()
-                    p = 0
-                    p1 = 0
-                    a1 = torch.cuda.memory_allocated()
-                    asingle = torch.tensor([1,1]).to(self.par.device)
-                    a2 = torch.cuda.memory_allocated()
-                    d = asingle.get_device()
-                    handle = pynvml.nvmlDeviceGetHandleByIndex(d)
-                    meminfo = pynvml.nvmlDeviceGetMemoryInfo(handle)
-                    p = int(meminfo.free/(a2-a1))
-                        
-                    if itstep != None and self.cutoff != None:
-                        if reconstep == None:
-                            reconstep = 10 #reconstep is 10 by default
-                        if reconstep <= 1:
-                            raise ValueError(" reconstep can not less than 2")
-                        if itstep % reconstep == 0:
-                            while p < len(idx):
-                                self.neighborlist = torch.tensor([[]]*2, dtype=int).T.to(self.par.device)
-                                ava_idx = torch.tensor(idx[p1:p].astype(int)).to(self.par.device)
-                                nb_dist, nb_unitvec, _ = calculate_distances(spos, ava_idx, sbox)
-                                if delt_r == None:
-                                    delt_r = self.cutoff
-                                _, _, vl = self._neighbor_verlet_list(
-                                    nb_dist, (nb_dist, nb_unitvec, ava_idx), delt_r
-                                )
-                                self.neighborlist = torch.cat((self.neighborlist,vl), axis = 0)
-                                torch.cuda.empty_cache()
-                                handle = pynvml.nvmlDeviceGetHandleByIndex(d)
-                                meminfo = pynvml.nvmlDeviceGetMemoryInfo(handle)
-                                p1 = p
-                                p = p + int(meminfo.free/(a2-a1))
-
-                            if p >= len(idx):
-                                ava_idx = torch.tensor(idx[p1:].astype(int)).to(self.par.device)
-                                nb_dist, nb_unitvec, _ = calculate_distances(spos, ava_idx, sbox)
-                                if delt_r == None:
-                                    delt_r = self.cutoff
-                                _, _, vl = self._neighbor_verlet_list(
-                                    nb_dist, (nb_dist, nb_unitvec, ava_idx), delt_r
-                                )
-                                self.neighborlist = torch.cat((self.neighborlist,vl), axis = 0)
-                        
-                        if self.neighborlist == None:
-                            raise ValueError("itration step should start from 0")
-                        nbv_dist, nbv_unitvec, _ = calculate_distances(spos, self.neighborlist, sbox)
-                        nb_dist, nb_unitvec, ava_idx = self._filter_by_cutoff(
-                            nbv_dist, (nbv_dist, nbv_unitvec, self.neighborlist)
-                        )
-                        for v in self.energies:
-                            if v == "electrostatics":
-                                E, force_coeff = evaluate_electrostatics(
-                                    nb_dist,
-                                    ava_idx,
-                                    self.par.charges,
-                                    cutoff=self.cutoff,
-                                    rfa=self.rfa,
-                                    solventDielectric=self.solventDielectric,
-                                    explicit_forces=explicit_forces,
-                                )
-                                pot[i][v] += E.sum()
-                            elif v == "lj":
-                                E, force_coeff = evaluate_LJ(
-                                    nb_dist,
-                                    ava_idx,
-                                    self.par.mapped_atom_types,
-                                    self.par.A,
-                                    self.par.B,
-                                    self.switch_dist,
-                                    self.cutoff,
-                                    explicit_forces,
-                                )
-                                pot[i][v] += E.sum()
-                            elif v == "repulsion":
-                                E, force_coeff = evaluate_repulsion(
-                                    nb_dist,
-                                    ava_idx,
-                                    self.par.mapped_atom_types,
-                                    self.par.A,
-                                    explicit_forces,
-                                )
-                                pot[i][v] += E.sum()
-                            elif v == "repulsioncg":
-                                E, force_coeff = evaluate_repulsion_CG(
-                                    nb_dist,
-                                    ava_idx,
-                                    self.par.mapped_atom_types,
-                                    self.par.B,
-                                    explicit_forces,
-                                )
-                                pot[i][v] += E.sum()
-                            else:
-                                continue
-                            
-                            if explicit_forces:
-                                forcevec = nb_unitvec * force_coeff[:, None]
-                                forces[i].index_add_(0, ava_idx[:, 0], -forcevec)
-                                forces[i].index_add_(0, ava_idx[:, 1], forcevec)
-                        del nb_dist, nb_unitvec, ava_idx
-                        torch.cuda.empty_cache()
-                        pynvml.nvmlShutdown()
-
-                    else:
-                        while p < len(idx):
-                            ava_idx = torch.tensor(idx[p1:p].astype(int)).to(self.par.device)
-    #breakpoint                        print(p)
-                            nb_dist, nb_unitvec, _ = calculate_distances(spos, ava_idx, sbox)
-    #breakpoint                        print('*')
-                            if self.cutoff is not None:
-                                nb_dist, nb_unitvec, ava_idx = self._filter_by_cutoff(
-                                    nb_dist, (nb_dist, nb_unitvec, ava_idx)
-                                )
-    #breakpoint                        print(ava_idx)
-                            for v in self.energies:
-                                if v == "electrostatics":
-                                    E, force_coeff = evaluate_electrostatics(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.charges,
-                                        cutoff=self.cutoff,
-                                        rfa=self.rfa,
-                                        solventDielectric=self.solventDielectric,
-                                        explicit_forces=explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "lj":
-                                    E, force_coeff = evaluate_LJ(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.A,
-                                        self.par.B,
-                                        self.switch_dist,
-                                        self.cutoff,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "repulsion":
-                                    E, force_coeff = evaluate_repulsion(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.A,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "repulsioncg":
-                                    E, force_coeff = evaluate_repulsion_CG(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.B,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                else:
-                                    continue
-                                
-                                if explicit_forces:
-                                    forcevec = nb_unitvec * force_coeff[:, None]
-                                    forces[i].index_add_(0, ava_idx[:, 0], -forcevec)
-                                    forces[i].index_add_(0, ava_idx[:, 1], forcevec)
-                            del nb_dist, nb_unitvec, ava_idx
-                            torch.cuda.empty_cache()
-                            handle = pynvml.nvmlDeviceGetHandleByIndex(d)
-                            meminfo = pynvml.nvmlDeviceGetMemoryInfo(handle)
-                            p1 = p
-                            p = p + int(meminfo.free/(a2-a1))
-                        if p >= len(idx):
-                            ava_idx = torch.tensor(idx[p1:].astype(int)).to(self.par.device)
-                            nb_dist, nb_unitvec, _ = calculate_distances(spos, ava_idx, sbox)
-                            if self.cutoff is not None:
-                                nb_dist, nb_unitvec, ava_idx = self._filter_by_cutoff(
-                                    nb_dist, (nb_dist, nb_unitvec, ava_idx)
-                                )
-                            for v in self.energies:
-                                if v == "electrostatics":
-                                    E, force_coeff = evaluate_electrostatics(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.charges,
-                                        cutoff=self.cutoff,
-                                        rfa=self.rfa,
-                                        solventDielectric=self.solventDielectric,
-                                        explicit_forces=explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "lj":
-                                    E, force_coeff = evaluate_LJ(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.A,
-                                        self.par.B,
-                                        self.switch_dist,
-                                        self.cutoff,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "repulsion":
-                                    E, force_coeff = evaluate_repulsion(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.A,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "repulsioncg":
-                                    E, force_coeff = evaluate_repulsion_CG(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.B,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                else:
-                                    continue
-                                
-                                if explicit_forces:
-                                    forcevec = nb_unitvec * force_coeff[:, None]
-                                    forces[i].index_add_(0, ava_idx[:, 0], -forcevec)
-                                    forces[i].index_add_(0, ava_idx[:, 1], forcevec)
-                            del nb_dist, nb_unitvec, ava_idx
-                            torch.cuda.empty_cache()
-                        pynvml.nvmlShutdown()
-                ffile.close()
-
-            if self.ava_idx != None and self.ava_idx.device != torch.device(self.par.device): #cuda 0 by default
-                if self.require_distances and len(self.ava_idx):
-                    import pynvml 
-                    pynvml.nvmlInit()
-                    p = 0
-                    p1 = 0
-                    a1 = torch.cuda.memory_allocated()
-                    asingle = torch.tensor([1,1]).to(self.par.device)
-                    a2 = torch.cuda.memory_allocated()
-                    d = asingle.get_device()
-                    handle = pynvml.nvmlDeviceGetHandleByIndex(d)
-                    meminfo = pynvml.nvmlDeviceGetMemoryInfo(handle)
-                    p = int(meminfo.free*0.8/(a2-a1))
-                    if itstep != None and self.cutoff != None:
-                        if reconstep == None:
-                            reconstep = 10 #reconstep is 10 by default
-                        if reconstep <= 1:
-                            raise ValueError(" reconstep can not less than 2")
-                        if itstep % reconstep == 0:
-                            while p < len(self.ava_idx):
-                                self.neighborlist = torch.tensor([[]]*2, dtype=int).T.to(self.par.device)
-                                ava_idx = self.ava_idx[p1:p].to(self.par.device)
-                                nb_dist, nb_unitvec, _ = calculate_distances(spos, ava_idx, sbox)
-                                if delt_r == None:
-                                    delt_r = self.cutoff
-                                _, _, vl = self._neighbor_verlet_list(
-                                    nb_dist, (nb_dist, nb_unitvec, ava_idx), delt_r
-                                )
-                                self.neighborlist = torch.cat((self.neighborlist,vl), axis = 0)
-                                torch.cuda.empty_cache()
-                                handle = pynvml.nvmlDeviceGetHandleByIndex(d)
-                                meminfo = pynvml.nvmlDeviceGetMemoryInfo(handle)
-                                p1 = p
-                                p = p + int(meminfo.free/(a2-a1))
-
-                            if p >= len(self.ava_idx):
-                                ava_idx = self.ava_idx[p1:].to(self.par.device)
-                                nb_dist, nb_unitvec, _ = calculate_distances(spos, ava_idx, sbox)
-                                _, _, vl = self._neighbor_verlet_list(
-                                    nb_dist, (nb_dist, nb_unitvec, ava_idx), delt_r
-                                )
-                                self.neighborlist = torch.cat((self.neighborlist,vl), axis = 0)
-                        
-                        if self.neighborlist == None:
-                            raise ValueError("itration step should start from 0")
-                        nbv_dist, nbv_unitvec, _ = calculate_distances(spos, self.neighborlist, sbox)
-                        nb_dist, nb_unitvec, ava_idx = self._filter_by_cutoff(
-                            nbv_dist, (nbv_dist, nbv_unitvec, self.neighborlist)
-                        )
-                        for v in self.energies:
-                            if v == "electrostatics":
-                                E, force_coeff = evaluate_electrostatics(
-                                    nb_dist,
-                                    ava_idx,
-                                    self.par.charges,
-                                    cutoff=self.cutoff,
-                                    rfa=self.rfa,
-                                    solventDielectric=self.solventDielectric,
-                                    explicit_forces=explicit_forces,
-                                )
-                                pot[i][v] += E.sum()
-                            elif v == "lj":
-                                E, force_coeff = evaluate_LJ(
-                                    nb_dist,
-                                    ava_idx,
-                                    self.par.mapped_atom_types,
-                                    self.par.A,
-                                    self.par.B,
-                                    self.switch_dist,
-                                    self.cutoff,
-                                    explicit_forces,
-                                )
-                                pot[i][v] += E.sum()
-                            elif v == "repulsion":
-                                E, force_coeff = evaluate_repulsion(
-                                    nb_dist,
-                                    ava_idx,
-                                    self.par.mapped_atom_types,
-                                    self.par.A,
-                                    explicit_forces,
-                                )
-                                pot[i][v] += E.sum()
-                            elif v == "repulsioncg":
-                                E, force_coeff = evaluate_repulsion_CG(
-                                    nb_dist,
-                                    ava_idx,
-                                    self.par.mapped_atom_types,
-                                    self.par.B,
-                                    explicit_forces,
-                                )
-                                pot[i][v] += E.sum()
-                            else:
-                                continue
-                            
-                            if explicit_forces:
-                                forcevec = nb_unitvec * force_coeff[:, None]
-                                forces[i].index_add_(0, ava_idx[:, 0], -forcevec)
-                                forces[i].index_add_(0, ava_idx[:, 1], forcevec)
-                        del nb_dist, nb_unitvec, ava_idx
-                        torch.cuda.empty_cache()
-                        pynvml.nvmlShutdown()
-                    else:
-                        while p < len(self.ava_idx):
-                            ava_idx = self.ava_idx[p1:p].to(self.par.device)
-                            nb_dist, nb_unitvec, _ = calculate_distances(spos, ava_idx, sbox)
-                            if self.cutoff is not None:
-                                nb_dist, nb_unitvec, ava_idx = self._filter_by_cutoff(
-                                    nb_dist, (nb_dist, nb_unitvec, ava_idx)
-                                )
-                            for v in self.energies:
-                                if v == "electrostatics":
-                                    E, force_coeff = evaluate_electrostatics(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.charges,
-                                        cutoff=self.cutoff,
-                                        rfa=self.rfa,
-                                        solventDielectric=self.solventDielectric,
-                                        explicit_forces=explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "lj":
-                                    E, force_coeff = evaluate_LJ(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.A,
-                                        self.par.B,
-                                        self.switch_dist,
-                                        self.cutoff,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "repulsion":
-                                    E, force_coeff = evaluate_repulsion(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.A,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "repulsioncg":
-                                    E, force_coeff = evaluate_repulsion_CG(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.B,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                else:
-                                    continue
-                                
-                                if explicit_forces:
-                                    forcevec = nb_unitvec * force_coeff[:, None]
-                                    forces[i].index_add_(0, ava_idx[:, 0], -forcevec)
-                                    forces[i].index_add_(0, ava_idx[:, 1], forcevec)
-                            del nb_dist, nb_unitvec, ava_idx
-                            torch.cuda.empty_cache()
-                            handle = pynvml.nvmlDeviceGetHandleByIndex(d)
-                            meminfo = pynvml.nvmlDeviceGetMemoryInfo(handle)
-                            p1 = p
-                            p = p + int(meminfo.free*0.8/(a2-a1))
-                        if p >= len(self.ava_idx):
-                            ava_idx = self.ava_idx[p1:].to(self.par.device)
-                            nb_dist, nb_unitvec, _ = calculate_distances(spos, ava_idx, sbox)
-                            if self.cutoff is not None:
-                                nb_dist, nb_unitvec, ava_idx = self._filter_by_cutoff(
-                                    nb_dist, (nb_dist, nb_unitvec, ava_idx)
-                                )
-                            for v in self.energies:
-                                if v == "electrostatics":
-                                    E, force_coeff = evaluate_electrostatics(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.charges,
-                                        cutoff=self.cutoff,
-                                        rfa=self.rfa,
-                                        solventDielectric=self.solventDielectric,
-                                        explicit_forces=explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "lj":
-                                    E, force_coeff = evaluate_LJ(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.A,
-                                        self.par.B,
-                                        self.switch_dist,
-                                        self.cutoff,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "repulsion":
-                                    E, force_coeff = evaluate_repulsion(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.A,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "repulsioncg":
-                                    E, force_coeff = evaluate_repulsion_CG(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.B,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                else:
-                                    continue
-                                
-                                if explicit_forces:
-                                    forcevec = nb_unitvec * force_coeff[:, None]
-                                    forces[i].index_add_(0, ava_idx[:, 0], -forcevec)
-                                    forces[i].index_add_(0, ava_idx[:, 1], forcevec)
-                            del nb_dist, nb_unitvec, ava_idx
-                            torch.cuda.empty_cache()
-                            pynvml.nvmlShutdown()
-                    
-#breakpoint to monitor the cuda memory                            print(torch.cuda.memory_reserved(),'a')
-            if self.ava_idx != None and self.ava_idx.device == torch.device(self.par.device):
-                if self.require_distances and len(self.ava_idx):
-                    try:
-                        nb_dist, nb_unitvec, _ = calculate_distances(spos, self.ava_idx, sbox)
-                        ava_idx = self.ava_idx
-                        if itstep != None and self.cutoff != None:
-                            if reconstep == None:
-                                reconstep = 10 #reconstep is 10 by default
-                            if reconstep <= 1:
-                                raise ValueError(" reconstep can not less than 2")
-                            if itstep % reconstep == 0:
-                                if delt_r == None:
-                                    delt_r = self.cutoff
-                                nb_dist, nb_unitvec, self.neighborlist  = self._neighbor_verlet_list(
-                                    nb_dist, (nb_dist, nb_unitvec, ava_idx), delt_r
-                                )
-                            if self.neighborlist == None:
-                                raise ValueError("itration step should start from 0")
-                            nbv_dist, nbv_unitvec, _ = calculate_distances(spos, self.neighborlist, sbox)
-                            nb_dist, nb_unitvec, ava_idx = self._filter_by_cutoff(
-                                nbv_dist, (nbv_dist, nbv_unitvec, self.neighborlist)
-                            )
-                            for v in self.energies:
-                                if v == "electrostatics":
-                                    E, force_coeff = evaluate_electrostatics(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.charges,
-                                        cutoff=self.cutoff,
-                                        rfa=self.rfa,
-                                        solventDielectric=self.solventDielectric,
-                                        explicit_forces=explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "lj":
-                                    E, force_coeff = evaluate_LJ(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.A,
-                                        self.par.B,
-                                        self.switch_dist,
-                                        self.cutoff,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "repulsion":
-                                    E, force_coeff = evaluate_repulsion(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.A,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "repulsioncg":
-                                    E, force_coeff = evaluate_repulsion_CG(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.B,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                else:
-                                    continue
-                                
-                                if explicit_forces:
-                                    forcevec = nb_unitvec * force_coeff[:, None]
-                                    forces[i].index_add_(0, ava_idx[:, 0], -forcevec)
-                                    forces[i].index_add_(0, ava_idx[:, 1], forcevec)
-                        else:
-                            if self.cutoff is not None:
-                                nb_dist, nb_unitvec, ava_idx = self._filter_by_cutoff(
-                                    nb_dist, (nb_dist, nb_unitvec, ava_idx)
-                                )
-                            for v in self.energies:
-                                if v == "electrostatics":
-                                    E, force_coeff = evaluate_electrostatics(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.charges,
-                                        cutoff=self.cutoff,
-                                        rfa=self.rfa,
-                                        solventDielectric=self.solventDielectric,
-                                        explicit_forces=explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "lj":
-                                    E, force_coeff = evaluate_LJ(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.A,
-                                        self.par.B,
-                                        self.switch_dist,
-                                        self.cutoff,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "repulsion":
-                                    E, force_coeff = evaluate_repulsion(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.A,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "repulsioncg":
-                                    E, force_coeff = evaluate_repulsion_CG(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.B,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                else:
-                                    continue
-                                
-                                if explicit_forces:
-                                    forcevec = nb_unitvec * force_coeff[:, None]
-                                    forces[i].index_add_(0, ava_idx[:, 0], -forcevec)
-                                    forces[i].index_add_(0, ava_idx[:, 1], forcevec)
-                        del nb_dist, nb_unitvec, ava_idx
-                        torch.cuda.empty_cache()
-                    except RuntimeError:
-                        print('Go to the RuntimeError part')
-                        import pynvml 
-                        pynvml.nvmlInit()
-                        p = 0
-                        p1 = 0
-                        a1 = torch.cuda.memory_allocated()
-                        asingle = torch.tensor([1,1]).to(self.par.device)
-                        a2 = torch.cuda.memory_allocated()
-                        d = asingle.get_device()
-                        handle = pynvml.nvmlDeviceGetHandleByIndex(d)
-                        meminfo = pynvml.nvmlDeviceGetMemoryInfo(handle)
-                        p = int(meminfo.free*0.8/(a2-a1))
-                        if itstep != None and self.cutoff != None:
-                            if reconstep == None:
-                                reconstep = 10 #reconstep is 10 by default
-                            if reconstep <= 1:
-                                raise ValueError(" reconstep can not less than 2")
-                            if itstep % reconstep == 0:
-                                while p < len(self.ava_idx):
-                                    self.neighborlist = torch.tensor([[]]*2, dtype=int).T.to(self.par.device)
-                                    ava_idx = self.ava_idx[p1:p]
-                                    nb_dist, nb_unitvec, _ = calculate_distances(spos, ava_idx, sbox)
-                                    if delt_r == None:
-                                        delt_r = self.cutoff
-                                    _, _, vl = self._neighbor_verlet_list(
-                                        nb_dist, (nb_dist, nb_unitvec, ava_idx), delt_r
-                                    )
-                                    self.neighborlist = torch.cat((self.neighborlist,vl), axis = 0)
-                                    torch.cuda.empty_cache()
-                                    handle = pynvml.nvmlDeviceGetHandleByIndex(d)
-                                    meminfo = pynvml.nvmlDeviceGetMemoryInfo(handle)
-                                    p1 = p
-                                    p = p + int(meminfo.free/(a2-a1))
-                                if p >= len(self.ava_idx):
-                                    ava_idx = self.ava_idx[p1:]
-                                    nb_dist, nb_unitvec, _ = calculate_distances(spos, ava_idx, sbox)
-                                    _, _, vl = self._neighbor_verlet_list(
-                                        nb_dist, (nb_dist, nb_unitvec, ava_idx), delt_r
-                                    )
-                                    self.neighborlist = torch.cat((self.neighborlist,vl), axis = 0)
-                            if self.neighborlist == None:
-                                raise ValueError("itration step should start from 0")
-                            nbv_dist, nbv_unitvec, _ = calculate_distances(spos, self.neighborlist, sbox)
-                            nb_dist, nb_unitvec, ava_idx = self._filter_by_cutoff(
-                                nbv_dist, (nbv_dist, nbv_unitvec, self.neighborlist)
-                            )
-                            for v in self.energies:
-                                if v == "electrostatics":
-                                    E, force_coeff = evaluate_electrostatics(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.charges,
-                                        cutoff=self.cutoff,
-                                        rfa=self.rfa,
-                                        solventDielectric=self.solventDielectric,
-                                        explicit_forces=explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "lj":
-                                    E, force_coeff = evaluate_LJ(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.A,
-                                        self.par.B,
-                                        self.switch_dist,
-                                        self.cutoff,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "repulsion":
-                                    E, force_coeff = evaluate_repulsion(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.A,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                elif v == "repulsioncg":
-                                    E, force_coeff = evaluate_repulsion_CG(
-                                        nb_dist,
-                                        ava_idx,
-                                        self.par.mapped_atom_types,
-                                        self.par.B,
-                                        explicit_forces,
-                                    )
-                                    pot[i][v] += E.sum()
-                                else:
-                                    continue
-                                
-                                if explicit_forces:
-                                    forcevec = nb_unitvec * force_coeff[:, None]
-                                    forces[i].index_add_(0, ava_idx[:, 0], -forcevec)
-                                    forces[i].index_add_(0, ava_idx[:, 1], forcevec)
-                        else:
-                            while p < len(self.ava_idx):
-                                ava_idx = self.ava_idx[p1:p]
-                                nb_dist, nb_unitvec, _ = calculate_distances(spos, ava_idx, sbox)
-                                if self.cutoff is not None:
-                                    nb_dist, nb_unitvec, ava_idx = self._filter_by_cutoff(
-                                        nb_dist, (nb_dist, nb_unitvec, ava_idx)
-                                    )
-
-                                for v in self.energies:
-                                    if v == "electrostatics":
-                                        E, force_coeff = evaluate_electrostatics(
-                                            nb_dist,
-                                            ava_idx,
-                                            self.par.charges,
-                                            cutoff=self.cutoff,
-                                            rfa=self.rfa,
-                                            solventDielectric=self.solventDielectric,
-                                            explicit_forces=explicit_forces,
-                                        )
-                                        pot[i][v] += E.sum()
-                                    elif v == "lj":
-                                        E, force_coeff = evaluate_LJ(
-                                            nb_dist,
-                                            ava_idx,
-                                            self.par.mapped_atom_types,
-                                            self.par.A,
-                                            self.par.B,
-                                            self.switch_dist,
-                                            self.cutoff,
-                                            explicit_forces,
-                                        )
-                                        pot[i][v] += E.sum()
-                                    elif v == "repulsion":
-                                        E, force_coeff = evaluate_repulsion(
-                                            nb_dist,
-                                            ava_idx,
-                                            self.par.mapped_atom_types,
-                                            self.par.A,
-                                            explicit_forces,
-                                        )
-                                        pot[i][v] += E.sum()
-                                    elif v == "repulsioncg":
-                                        E, force_coeff = evaluate_repulsion_CG(
-                                            nb_dist,
-                                            ava_idx,
-                                            self.par.mapped_atom_types,
-                                            self.par.B,
-                                            explicit_forces,
-                                        )
-                                        pot[i][v] += E.sum()
-                                    else:
-                                        continue
-                                    
-                                    if explicit_forces:
-                                        forcevec = nb_unitvec * force_coeff[:, None]
-                                        forces[i].index_add_(0, ava_idx[:, 0], -forcevec)
-                                        forces[i].index_add_(0, ava_idx[:, 1], forcevec)
-                                del nb_dist, nb_unitvec, ava_idx
-                                torch.cuda.empty_cache()
-                                handle = pynvml.nvmlDeviceGetHandleByIndex(d)
-                                meminfo = pynvml.nvmlDeviceGetMemoryInfo(handle)
-                                p1 = p
-                                p = p + int(meminfo.free*0.8/(a2-a1))
-                            if p >= len(self.ava_idx):
-                                ava_idx = self.ava_idx[p1:].to(self.par.device)
-                                nb_dist, nb_unitvec, _ = calculate_distances(spos, ava_idx, sbox)
-                                if self.cutoff is not None:
-                                    nb_dist, nb_unitvec, ava_idx = self._filter_by_cutoff(
-                                        nb_dist, (nb_dist, nb_unitvec, ava_idx)
-                                    )
-                                for v in self.energies:
-                                    if v == "electrostatics":
-                                        E, force_coeff = evaluate_electrostatics(
-                                            nb_dist,
-                                            ava_idx,
-                                            self.par.charges,
-                                            cutoff=self.cutoff,
-                                            rfa=self.rfa,
-                                            solventDielectric=self.solventDielectric,
-                                            explicit_forces=explicit_forces,
-                                        )
-                                        pot[i][v] += E.sum()
-                                    elif v == "lj":
-                                        E, force_coeff = evaluate_LJ(
-                                            nb_dist,
-                                            ava_idx,
-                                            self.par.mapped_atom_types,
-                                            self.par.A,
-                                            self.par.B,
-                                            self.switch_dist,
-                                            self.cutoff,
-                                            explicit_forces,
-                                        )
-                                        pot[i][v] += E.sum()
-                                    elif v == "repulsion":
-                                        E, force_coeff = evaluate_repulsion(
-                                            nb_dist,
-                                            ava_idx,
-                                            self.par.mapped_atom_types,
-                                            self.par.A,
-                                            explicit_forces,
-                                        )
-                                        pot[i][v] += E.sum()
-                                    elif v == "repulsioncg":
-                                        E, force_coeff = evaluate_repulsion_CG(
-                                            nb_dist,
-                                            ava_idx,
-                                            self.par.mapped_atom_types,
-                                            self.par.B,
-                                            explicit_forces,
-                                        )
-                                        pot[i][v] += E.sum()
-                                    else:
-                                        continue
-                                    
-                                    if explicit_forces:
-                                        forcevec = nb_unitvec * force_coeff[:, None]
-                                        forces[i].index_add_(0, ava_idx[:, 0], -forcevec)
-                                        forces[i].index_add_(0, ava_idx[:, 1], forcevec)
-                                del nb_dist, nb_unitvec, ava_idx
-                                torch.cuda.empty_cache()
-                                pynvml.nvmlShutdown()
-                    
         if self.external:
             ext_ene, ext_force = self.external.calculate(pos, box)
-            for s in range(nsystems):
-                pot[s]["external"] += ext_ene[s]
+            ext_ene = ext_ene.reshape(nsystems, -1).sum(dim=1)
+            pot[:, self._term_ids["external"]] += ext_ene
             if explicit_forces:
                 forces += ext_force
         
-        if itstep != None:
-            if not explicit_forces:
-                enesum = torch.zeros(1, device=pos.device, dtype=pos.dtype)
-                for i in range(nsystems):
-                    for ene in pot[i]:
-                        if pot[i][ene].requires_grad:
-                            enesum += pot[i][ene]
-                forces[:] = -torch.autograd.grad(
-                    enesum, pos, only_inputs=True, retain_graph=True
-                )[0]
-                if returnDetails:
-                    return pot, self.neighborlist
-                else:
-                    return [torch.sum(torch.cat(list(pp.values()))) for pp in pot], self.neighborlist
-
+        if not explicit_forces:
+            # pot holds every term of every system so the total energy is a single reduction node
+            # The graph is freed by the backward pass, the returned energies are only meant to be read
+            forces[:] = -torch.autograd.grad(pot.sum(), pos)[0]
             if returnDetails:
-                return [{k: v.cpu().item() for k, v in pp.items()} for pp in pot], self.neighborlist
+                ret = [
+                    {k: pot[i, j : j + 1] for k, j in self._term_ids.items()}
+                    for i in range(nsystems)
+                ]
             else:
-                return [np.sum([v.cpu().item() for _, v in pp.items()]) for pp in pot], self.neighborlist
-        
+                ret = list(pot.sum(dim=1))
+        elif returnDetails:
+            rows = pot.detach().cpu().tolist()
+            ret = [{k: row[j] for k, j in self._term_ids.items()} for row in rows]
         else:
-            if not explicit_forces:
-                enesum = torch.zeros(1, device=pos.device, dtype=pos.dtype)
-                for i in range(nsystems):
-                    for ene in pot[i]:
-                        if pot[i][ene].requires_grad:
-                            enesum += pot[i][ene]
-                forces[:] = -torch.autograd.grad(
-                    enesum, pos, only_inputs=True, retain_graph=True
-                )[0]
-                if returnDetails:
-                    return pot
-                else:
-                    return [torch.sum(torch.cat(list(pp.values()))) for pp in pot]
+            # Summed on the device in double precision so that only one value per system is copied
+            ret = pot.detach().sum(dim=1, dtype=torch.float64).cpu().tolist()
 
-            if returnDetails:
-                return [{k: v.cpu().item() for k, v in pp.items()} for pp in pot]
-            else:
-                return [np.sum([v.cpu().item() for _, v in pp.items()]) for pp in pot]
+        if itstep is not None:
+            return ret, self.neighborlist
+        return ret
+
+    def close(self):
+        """Closes the pair file kept open when the pairs did not fit in memory
+
+        A Forces relying on the pair file can not compute any more once it is closed.
+        """
+        if self._pair_file is not None:
+            self._pair_file.close()
+            self._pair_file = None
+
+    def __del__(self):
+        # __init__ may have failed before the pair file was opened
+        if getattr(self, "_pair_file", None) is not None:
+            self.close()
 
     def _make_indeces(self, natoms, excludepairs, device):
 #if cpu memory is larger than the gpu's
         ava_idx = None
-        l_excludepairs = len(excludepairs)
         try:
-            fmatrix = np.full((natoms, natoms), True, dtype=bool)
-            if l_excludepairs:
-                excludepairs = np.array(excludepairs)
-                fmatrix[excludepairs[:, 0], excludepairs[:, 1]] = False
-                fmatrix[excludepairs[:, 1], excludepairs[:, 0]] = False
-            np.where(fmatrix) #check the available memory 
-            fmatrix = np.triu(fmatrix, +1)
-            ava_idx_i = np.vstack(np.where(fmatrix)).T
+            ava_idx_i = torch.from_numpy(_all_pairs(natoms, excludepairs)).T
 #breakpoint            print(torch.cuda.memory_reserved(),'a')
             try:
-                ava_idx = torch.tensor(ava_idx_i).to(device)
+                ava_idx = ava_idx_i.to(device)
             except RuntimeError:
                 print('cuda is out of memory but the internal memory of cpu is enough')
-                torch.cuda.empty_cache()
                 #Solution: turn ava_idx to be stored in the cpu
-                ava_idx = torch.tensor(ava_idx_i).to('cpu')
+                #The caching allocator keeps its pool for the pair chunks, set
+                #PYTORCH_CUDA_ALLOC_CONF=expandable_segments:True if fragmentation is a problem
+                ava_idx = ava_idx_i
         except MemoryError:
             print('both cpu and gpu are out of memory')
             #Solution-2: We put the data to the outside(external memory).
-            if os.path.exists('non-interactions.h5') != True:
+            #The pairs are streamed to the file block by block. An existing file is only reused if it was written for
+            #the same number of atoms and exclusions, which are stored as attributes of the pair array
+            excl_keys = _exclusion_keys(natoms, excludepairs)
+            npairs = _num_pairs(natoms, excl_keys)
+            digest = hashlib.sha1(b'' if excl_keys is None else excl_keys.tobytes()).hexdigest()
+            stale = True
+            if os.path.exists('non-interactions.h5'):
+                with t.open_file('non-interactions.h5', 'r') as ffile:
+                    data = getattr(ffile.root, 'data', None)
+                    stale = (
+                        data is None
+                        or data.nrows != npairs
+                        or getattr(data.attrs, 'natoms', None) != natoms
+                        or getattr(data.attrs, 'exclusions', None) != digest
+                    )
+            if stale:
+                #The file is written under a temporary name and moved in place, other Forces still reading the
+                #previous file keep their own open handle to it
+                fd, tmpname = tempfile.mkstemp(prefix='non-interactions', suffix='.h5', dir='.')
+                os.close(fd)
                 filters = t.Filters(complevel=5,complib='blosc')
-                ffile = t.open_file('non-interactions.h5', mode = 'w', title = 'index')
-                import psutil
-                import sys
-                singlesize = sys.getsizeof(np.full((1,1),True,dtype=bool))
-                length = int(psutil.virtual_memory().free/singlesize/natoms)
-                length_i = length
-                m = 0
-                length0 = 0
-                ava = np.array([[]]*2).T
-#breakpoint                print(psutil.virtual_memory(),'1')
-                i = 0
-                earray = ffile.create_earray(ffile.root, 'data', atom=t.Atom.from_dtype(ava.dtype), shape=(0,2), filters=filters, expectedrows=int(natoms*natoms*0.8))
-                if l_excludepairs:
-                    excludepairs = np.array(excludepairs)
-                    ex_index = np.lexsort((excludepairs[:,1],excludepairs[:,0]))
-                    excludepairs = excludepairs[ex_index]
-                while length <= natoms :
-                    fmatrix = np.full((length_i, natoms), True, dtype=bool)
-                    if l_excludepairs and m < l_excludepairs-1:
-                        for j in range(m, l_excludepairs):
-                            if excludepairs[j,0] >= length:
-                                m1 = m
-                                m = j
-                                break
-                            else:
-                                if j == l_excludepairs-1:
-                                    m1 = m
-                                    m = j+1
-                        excludepairs_i = excludepairs[m1:m]
-                        fmatrix[excludepairs_i[:, 0]-length0, excludepairs_i[:, 1]] = False
-#breakpoint                    print(i) 
-#breakpoint                    print(excludepairs_i)
-                    fmatrix = np.triu(fmatrix, length0+1)
-                    allvsall_indeces = np.vstack(np.where(fmatrix)).T
-                    allvsall_indeces = np.vstack((allvsall_indeces[:,0]+length0,allvsall_indeces[:,1])).T
-                    allvsall_indeces = allvsall_indeces.astype(int)
-                    earray.append(allvsall_indeces)
-                    i += 1
-                    length_i = int(psutil.virtual_memory().free/singlesize/natoms)
-                    length0 = length
-                    length = length + length_i
-#breakpoint                    print(len(allvsall_indeces),'**')
-                if length > natoms:
-                    fmatrix = np.full((natoms - length0, natoms), True, dtype=bool)
-                    if l_excludepairs and m < l_excludepairs:
-                        excludepairs_i = excludepairs[m:]
-                        fmatrix[excludepairs_i[:, 0] - length0, excludepairs_i[:, 1]] = False
-                    fmatrix = np.triu(fmatrix, length0+1)
-                    allvsall_indeces = np.vstack(np.where(fmatrix)).T
-                    allvsall_indeces = np.vstack((allvsall_indeces[:,0]+length0,allvsall_indeces[:,1])).T
-                    allvsall_indeces = allvsall_indeces.astype(int)
-                    earray.append(allvsall_indeces)
+                ffile = t.open_file(tmpname, mode = 'w', title = 'index')
+                earray = ffile.create_earray(
+                    ffile.root,
+                    'data',
+                    atom=t.Int32Atom(),
+                    shape=(0, 2),
+                    filters=filters,
+                    expectedrows=npairs,
+                )
+                earray.attrs.natoms = natoms
+                earray.attrs.exclusions = digest
+                for block in _pair_blocks(natoms, excl_keys):
+                    earray.append(block.T)
                 ffile.close()
+                os.replace(tmpname, 'non-interactions.h5')
         return ava_idx
 
 
-def wrap_dist(dist, box):
-    if box is None or torch.all(box == 0):
-        wdist = dist
+def _select_pairs(arr, kept):
+    # Rows `kept` of a per-pair array, column-major (npairs, k) tables are selected through their (k, npairs) view
+    # so that they stay column-major
+    if arr.dim() == 2 and arr.T.is_contiguous():
+        return arr.T.index_select(1, kept).T
+    return arr.index_select(0, kept)
+
+
+def _exclusion_keys(natoms, excludepairs):
+    # Sorted unique keys i * natoms + j of the excluded i < j pairs
+    if not len(excludepairs):
+        return None
+    excl = np.sort(np.array(excludepairs, dtype=np.int64), axis=1)
+    excl = excl[excl[:, 0] != excl[:, 1]]
+    return np.unique(excl[:, 0] * natoms + excl[:, 1])
+
+
+def _num_pairs(natoms, excl_keys):
+    # Number of unique i < j pairs left after removing the excluded ones
+    npairs = natoms * (natoms - 1) // 2
+    if excl_keys is not None:
+        npairs -= len(excl_keys)
+    return npairs
+
+
+def _pair_blocks(natoms, excl_keys):
+    """Yields (2, n) int32 blocks of all unique i < j pairs without the excluded ones
+
+    Every block holds the pairs of a few consecutive rows, about PAIR_BLOCK of them, so that neither a natoms x natoms
+    matrix nor temporaries of the size of the whole pair list are needed.
+    """
+    rows = max(1, PAIR_BLOCK // max(natoms, 1))
+    for start in range(0, natoms, rows):
+        ii = np.arange(start, min(start + rows, natoms), dtype=np.int64)
+        counts = natoms - 1 - ii
+        first = np.cumsum(counts) - counts
+        jj = np.arange(counts.sum()) - np.repeat(first - ii - 1, counts)
+        ii = np.repeat(ii, counts)
+        if excl_keys is not None and len(excl_keys):
+            keys = ii * natoms + jj
+            loc = np.minimum(np.searchsorted(excl_keys, keys), len(excl_keys) - 1)
+            keep = excl_keys[loc] != keys
+            ii, jj = ii[keep], jj[keep]
+        yield np.stack((ii, jj)).astype(np.int32)
+
+
+def _all_pairs(natoms, excludepairs):
+    """Returns the (2, npairs) int32 array of all unique i < j pairs without the excluded ones
+
+    The blocks of _pair_blocks are written into the preallocated result.
+    """
+    excl_keys = _exclusion_keys(natoms, excludepairs)
+    pairs = np.empty((2, _num_pairs(natoms, excl_keys)), dtype=np.int32)
+    n = 0
+    for block in _pair_blocks(natoms, excl_keys):
+        pairs[:, n : n + block.shape[1]] = block
+        n += block.shape[1]
+    return pairs
+
+
+BONDED_ENERGIES = ("bonds", "angles", "dihedrals", "impropers", "lj", "electrostatics")
+
+
+def evaluate_bonded(
+    spos,
+    sbox,
+    par,
+    energies,
+    bonded_pairs,
+    slices,
+    cutoff,
+    nsystems=1,
+    explicit_forces=True,
+    inv_box=None,
+):
+    """Evaluates the bonded terms (including the 1-4 interactions) of `nsystems` systems at once
+
+    The positions of all systems are flattened into `spos` and `sbox` holds the box of every pair in `bonded_pairs`,
+    or a single box shared by all of them. `inv_box` optionally holds the matching `inverse_box`.
+    Returns a tuple with the per-system energies in the order of `BONDED_ENERGIES` and the forces on the atoms.
+    Only operates on tensors so that it can be compiled with `torch.compile`.
+    """
+    zero = torch.zeros(nsystems, device=spos.device, dtype=spos.dtype)
+    E_bonds, E_angles, E_dihedrals, E_impropers, E_lj14, E_elec14 = (zero,) * 6
+    frc = torch.zeros_like(spos) if explicit_forces else None
+
+    dist, unitvec, vec = calculate_distances(spos, bonded_pairs, sbox, inv_box)
+
+    if "bonds" in energies and par.bonds is not None:
+        bond_dist = dist[slices["bonds"]]
+        bond_unitvec = unitvec[slices["bonds"]]
+        E, force_coeff = evaluate_bonds(bond_dist, par.bond_params, explicit_forces)
+        if cutoff is not None:
+            # Mask the bonds beyond the cutoff so that every system keeps the same number of bonds
+            under_cutoff = (bond_dist <= cutoff).type(E.dtype)
+            E = E * under_cutoff
+            if explicit_forces:
+                force_coeff = force_coeff * under_cutoff
+
+        E_bonds = E.view(nsystems, -1).sum(dim=1)
+        if explicit_forces:
+            scatter_pair_forces(frc, par.bonds, bond_unitvec, force_coeff)
+
+    if "angles" in energies and par.angles is not None:
+        r21 = vec[slices["angles_21"]]
+        r23 = vec[slices["angles_23"]]
+        E, angle_forces = evaluate_angles(r21, r23, par.angle_params, explicit_forces)
+
+        E_angles = E.view(nsystems, -1).sum(dim=1)
+        if explicit_forces:
+            frc.index_add_(0, par.angles[:, 0], angle_forces[0])
+            frc.index_add_(0, par.angles[:, 1], angle_forces[1])
+            frc.index_add_(0, par.angles[:, 2], angle_forces[2])
+
+    if "dihedrals" in energies and par.dihedrals is not None:
+        r12 = vec[slices["dihedrals_12"]]
+        r23 = vec[slices["dihedrals_23"]]
+        r34 = vec[slices["dihedrals_34"]]
+        E, dihedral_forces = evaluate_torsion(
+            r12, r23, r34, par.dihedral_params, explicit_forces
+        )
+
+        E_dihedrals = E.view(nsystems, -1).sum(dim=1)
+        if explicit_forces:
+            frc.index_add_(0, par.dihedrals[:, 0], dihedral_forces[0])
+            frc.index_add_(0, par.dihedrals[:, 1], dihedral_forces[1])
+            frc.index_add_(0, par.dihedrals[:, 2], dihedral_forces[2])
+            frc.index_add_(0, par.dihedrals[:, 3], dihedral_forces[3])
+
+    if "1-4" in energies and par.idx14 is not None:
+        nb_dist = dist[slices["1-4"]]
+        nb_unitvec = unitvec[slices["1-4"]]
+        idx14 = par.idx14
+
+        aa = par.nonbonded_14_params[:, 0]
+        bb = par.nonbonded_14_params[:, 1]
+        scnb = par.nonbonded_14_params[:, 2]
+        scee = par.nonbonded_14_params[:, 3]
+
+        # Both 1-4 terms act along the same pairs so their forces are scattered together
+        coeff14 = None
+        if "lj" in energies:
+            E, coeff14 = evaluate_LJ_internal(
+                nb_dist, aa, bb, scnb, None, None, explicit_forces
+            )
+            E_lj14 = E.view(nsystems, -1).sum(dim=1)
+        if "electrostatics" in energies:
+            E, force_coeff = evaluate_electrostatics(
+                nb_dist,
+                idx14,
+                par.charges,
+                scee,
+                cutoff=None,
+                rfa=False,
+                explicit_forces=explicit_forces,
+            )
+            E_elec14 = E.view(nsystems, -1).sum(dim=1)
+            if explicit_forces:
+                coeff14 = force_coeff if coeff14 is None else coeff14 + force_coeff
+        if explicit_forces and coeff14 is not None:
+            scatter_pair_forces(frc, idx14, nb_unitvec, coeff14)
+
+    if "impropers" in energies and par.impropers is not None:
+        r12 = vec[slices["impropers_12"]]
+        r23 = vec[slices["impropers_23"]]
+        r34 = vec[slices["impropers_34"]]
+        E, improper_forces = evaluate_torsion(
+            r12, r23, r34, par.improper_params, explicit_forces
+        )
+
+        E_impropers = E.view(nsystems, -1).sum(dim=1)
+        if explicit_forces:
+            frc.index_add_(0, par.impropers[:, 0], improper_forces[0])
+            frc.index_add_(0, par.impropers[:, 1], improper_forces[1])
+            frc.index_add_(0, par.impropers[:, 2], improper_forces[2])
+            frc.index_add_(0, par.impropers[:, 3], improper_forces[3])
+
+    return (E_bonds, E_angles, E_dihedrals, E_impropers, E_lj14, E_elec14), frc
+
+
+def evaluate_nonbonded(
+    dist,
+    pairs,
+    systems,
+    nsystems,
+    terms,
+    charges,
+    atom_types,
+    A,
+    B,
+    cutoff=None,
+    rfa=False,
+    solventDielectric=78.5,
+    switch_dist=None,
+    explicit_forces=True,
+    within=None,
+    lj_params=None,
+    elec_factors=None,
+):
+    """Evaluates all non-bonded `terms` of the given pairs in a single call
+
+    `systems` gives the system of every pair, or is None if all pairs belong to a single system. Pairs which are not
+    set in the boolean mask `within` do not contribute, which keeps the shapes fixed compared to dropping them.
+    `lj_params` optionally holds the already looked up (npairs, 2) LJ A and B of every pair and `elec_factors` the
+    `_coulomb_factors` of every pair.
+    Returns the (nsystems, len(terms)) energies and the force coefficient of every pair summed over all terms, as
+    they all act along the same pair vectors. Keeping the terms and their reduction together lets `torch.compile`
+    fuse them into one pass over the pair distances.
+    Raises a ValueError before evaluating anything if any of the `terms` is not a non-bonded term.
+    """
+    for v in terms:
+        if v not in Forces.nonbonded:
+            raise ValueError(f"Force term {v} is not a non-bonded term.")
+
+    energies = []
+    force_coeff = None
+    for v in terms:
+        if v == "electrostatics":
+            E, coeff = evaluate_electrostatics(
+                dist,
+                pairs,
+                charges,
+                cutoff=cutoff,
+                rfa=rfa,
+                solventDielectric=solventDielectric,
+                explicit_forces=explicit_forces,
+                common=elec_factors,
+            )
+        elif v == "lj" and lj_params is not None:
+            E, coeff = evaluate_LJ_internal(
+                dist,
+                lj_params[:, 0],
+                lj_params[:, 1],
+                1,
+                switch_dist,
+                cutoff,
+                explicit_forces,
+            )
+        elif v == "lj":
+            E, coeff = evaluate_LJ(
+                dist,
+                pairs,
+                atom_types,
+                A,
+                B,
+                switch_dist,
+                cutoff,
+                explicit_forces=explicit_forces,
+            )
+        elif v == "repulsion":
+            E, coeff = evaluate_repulsion(
+                dist, pairs, atom_types, A, explicit_forces=explicit_forces
+            )
+        elif v == "repulsioncg":
+            E, coeff = evaluate_repulsion_CG(
+                dist, pairs, atom_types, B, explicit_forces=explicit_forces
+            )
+        energies.append(E)
+        if explicit_forces:
+            force_coeff = coeff if force_coeff is None else force_coeff + coeff
+
+    energies = torch.stack(energies, dim=1)
+    if within is not None:
+        energies = energies * within.unsqueeze(1)
+        if explicit_forces:
+            force_coeff = force_coeff * within
+    if systems is None:
+        energies = energies.sum(dim=0, keepdim=True)
     else:
-        wdist = dist - box.unsqueeze(0) * torch.round(dist / box.unsqueeze(0))
-    return wdist
+        energies = torch.zeros(
+            (nsystems, len(terms)), device=energies.device, dtype=energies.dtype
+        ).index_add_(0, systems, energies)
+    return energies, force_coeff
 
 
-def calculate_distances(atom_pos, atom_idx, box):
-    direction_vec = wrap_dist(atom_pos[atom_idx[:, 0]] - atom_pos[atom_idx[:, 1]], box)
-    dist = torch.norm(direction_vec, dim=1)
-    direction_unitvec = direction_vec / dist.unsqueeze(1)
-    return dist, direction_unitvec, direction_vec
+def scatter_pair_forces(forces, pairs, unitvec, force_coeff):
+    """Adds the pair forces along `unitvec` to both atoms of every pair, with opposite signs
+
+    Both atoms are updated with a single index_add_ over the (2, npairs) view of the pairs.
+    """
+    signed_coeff = torch.stack((-force_coeff, force_coeff))
+    forcevec = signed_coeff.unsqueeze(2) * unitvec.unsqueeze(0)
+    forces.index_add_(0, pairs.T.reshape(-1), forcevec.reshape(-1, 3))
 
 
 ELEC_FACTOR = 1 / (4 * const.pi * const.epsilon_0)  # Coulomb's constant
@@ -1219,12 +1035,17 @@ ELEC_FACTOR /= const.angstrom  # Convert Angstroms to meters
 ELEC_FACTOR *= const.Avogadro / (const.kilo * const.calorie)  # Convert J to kcal/mol
 
 
+def _pair_params(pair_indeces, atom_types, *tables):
+    # Looks up the (ntypes, ntypes) parameter tables of every pair with a single packed index into the flat tables
+    type_i, type_j = atom_types[pair_indeces].unbind(1)
+    flat_idx = type_i * tables[0].shape[1] + type_j
+    return tuple(table.reshape(-1)[flat_idx] for table in tables)
+
+
 def evaluate_LJ(
     dist, pair_indeces, atom_types, A, B, switch_dist, cutoff, explicit_forces=True
 ):
-    atomtype_indices = atom_types[pair_indeces]
-    aa = A[atomtype_indices[:, 0], atomtype_indices[:, 1]]
-    bb = B[atomtype_indices[:, 0], atomtype_indices[:, 1]]
+    aa, bb = _pair_params(pair_indeces, atom_types, A, B)
     return evaluate_LJ_internal(dist, aa, bb, 1, switch_dist, cutoff, explicit_forces)
 
 
@@ -1233,25 +1054,24 @@ def evaluate_LJ_internal(
 ):
     force = None
 
+    # The repulsive and dispersive parts are shared between the energy and the force
     rinv1 = 1 / dist
     rinv6 = rinv1 ** 6
-    rinv12 = rinv6 * rinv6
+    rep12 = aa * rinv6 * rinv6 / scale
+    disp6 = bb * rinv6 / scale
 
-    pot = ((aa * rinv12) - (bb * rinv6)) / scale
+    pot = rep12 - disp6
     if explicit_forces:
-        force = (-12 * aa * rinv12 + 6 * bb * rinv6) * rinv1 / scale
+        force = (6 * disp6 - 12 * rep12) * rinv1
 
-    # Switching function
+    # Switching function, which is exactly 1 below switch_dist and 0 beyond the cutoff, both with zero derivative
     if switch_dist is not None and cutoff is not None:
-        mask = dist > switch_dist
-        t = (dist[mask] - switch_dist) / (cutoff - switch_dist)
+        t = torch.clamp((dist - switch_dist) / (cutoff - switch_dist), min=0, max=1)
         switch_val = 1 + t * t * t * (-10 + t * (15 - t * 6))
         if explicit_forces:
             switch_deriv = t * t * (-30 + t * (60 - t * 30)) / (cutoff - switch_dist)
-            force[mask] = (
-                switch_val * force[mask] + pot[mask] * switch_deriv / dist[mask]
-            )
-        pot[mask] = pot[mask] * switch_val
+            force = switch_val * force + pot * switch_deriv * rinv1
+        pot = pot * switch_val
 
     return pot, force
 
@@ -1261,16 +1081,14 @@ def evaluate_repulsion(
 ):  # LJ without B
     force = None
 
-    atomtype_indices = atom_types[pair_indeces]
-    aa = A[atomtype_indices[:, 0], atomtype_indices[:, 1]]
+    (aa,) = _pair_params(pair_indeces, atom_types, A)
 
     rinv1 = 1 / dist
     rinv6 = rinv1 ** 6
-    rinv12 = rinv6 * rinv6
 
-    pot = (aa * rinv12) / scale
+    pot = aa * rinv6 * rinv6 / scale
     if explicit_forces:
-        force = (-12 * aa * rinv12) * rinv1 / scale
+        force = -12 * pot * rinv1
     return pot, force
 
 
@@ -1279,18 +1097,33 @@ def evaluate_repulsion_CG(
 ):  # Repulsion like from CGNet
     force = None
 
-    atomtype_indices = atom_types[pair_indeces]
-    coef = B[atomtype_indices[:, 0], atomtype_indices[:, 1]]
+    (coef,) = _pair_params(pair_indeces, atom_types, B)
 
     rinv1 = 1 / dist
     rinv6 = rinv1 ** 6
 
     pot = (coef * rinv6) / scale
     if explicit_forces:
-        force = (-6 * coef * rinv6) * rinv1 / scale
+        force = -6 * pot * rinv1
     return pot, force
 
 
+def _coulomb_factors(pair_indeces, atom_charges, scale=1):
+    # Constant ELEC_FACTOR * q_i * q_j / scale of every pair, which only changes with the pairs themselves
+    charge_i, charge_j = atom_charges[pair_indeces].unbind(1)
+    return (ELEC_FACTOR / scale) * charge_i * charge_j
+
+
+def _reaction_field(cutoff, solventDielectric):
+    # http://docs.openmm.org/latest/userguide/theory.html#coulomb-interaction-with-cutoff
+    # Ilario G. Tironi, René Sperb, Paul E. Smith, and Wilfred F. van Gunsteren. A generalized reaction field method
+    # for molecular dynamics simulations. Journal of Chemical Physics, 102(13):5451–5459, 1995.
+    denom = (2 * solventDielectric) + 1
+    krf = (1 / cutoff ** 3) * (solventDielectric - 1) / denom
+    crf = (1 / cutoff) * (3 * solventDielectric) / denom
+    return krf, crf
+
+
 def evaluate_electrostatics(
     dist,
     pair_indeces,
@@ -1300,35 +1133,23 @@ def evaluate_electrostatics(
     rfa=False,
     solventDielectric=78.5,
     explicit_forces=True,
+    common=None,
 ):
+    # `common` optionally holds the already computed _coulomb_factors of the pairs, in which case the charges are
+    # not looked up
     force = None
+    if common is None:
+        common = _coulomb_factors(pair_indeces, atom_charges, scale)
+    rinv1 = 1 / dist
     if rfa:  # Reaction field approximation for electrostatics with cutoff
-        # http://docs.openmm.org/latest/userguide/theory.html#coulomb-interaction-with-cutoff
-        # Ilario G. Tironi, René Sperb, Paul E. Smith, and Wilfred F. van Gunsteren. A generalized reaction field method
-        # for molecular dynamics simulations. Journal of Chemical Physics, 102(13):5451–5459, 1995.
-        denom = (2 * solventDielectric) + 1
-        krf = (1 / cutoff ** 3) * (solventDielectric - 1) / denom
-        crf = (1 / cutoff) * (3 * solventDielectric) / denom
-        common = (
-            ELEC_FACTOR
-            * atom_charges[pair_indeces[:, 0]]
-            * atom_charges[pair_indeces[:, 1]]
-            / scale
-        )
-        dist2 = dist ** 2
-        pot = common * ((1 / dist) + krf * dist2 - crf)
+        krf, crf = _reaction_field(cutoff, solventDielectric)
+        pot = common * (rinv1 + krf * dist * dist - crf)
         if explicit_forces:
-            force = common * (2 * krf * dist - 1 / dist2)
+            force = common * (2 * krf * dist - rinv1 * rinv1)
     else:
-        pot = (
-            ELEC_FACTOR
-            * atom_charges[pair_indeces[:, 0]]
-            * atom_charges[pair_indeces[:, 1]]
-            / dist
-            / scale
-        )
+        pot = common * rinv1
         if explicit_forces:
-            force = -pot / dist
+            force = -pot * rinv1
     return pot, force
 
 
@@ -1338,9 +1159,10 @@ def evaluate_bonds(dist, bond_params, explicit_forces=True):
     k0 = bond_params[:, 0]
     d0 = bond_params[:, 1]
     x = dist - d0
-    pot = k0 * (x ** 2)
+    k0x = k0 * x
+    pot = k0x * x
     if explicit_forces:
-        force = 2 * k0 * x
+        force = 2 * k0x
     return pot, force
 
 
@@ -1349,8 +1171,8 @@ def evaluate_angles(r21, r23, angle_params, explicit_forces=True):
     theta0 = angle_params[:, 1]
 
     dotprod = torch.sum(r23 * r21, dim=1)
-    norm23inv = 1 / torch.norm(r23, dim=1)
-    norm21inv = 1 / torch.norm(r21, dim=1)
+    norm23inv = torch.rsqrt(torch.sum(r23 * r23, dim=1))
+    norm21inv = torch.rsqrt(torch.sum(r21 * r21, dim=1))
 
     cos_theta = dotprod * norm21inv * norm23inv
     cos_theta = torch.clamp(cos_theta, -1, 1)
@@ -1362,73 +1184,124 @@ def evaluate_angles(r21, r23, angle_params, explicit_forces=True):
     force0, force1, force2 = None, None, None
     if explicit_forces:
         sin_theta = torch.sqrt(1.0 - cos_theta * cos_theta)
-        coef = torch.zeros_like(sin_theta)
         nonzero = sin_theta != 0
-        coef[nonzero] = -2.0 * k0[nonzero] * delta_theta[nonzero] / sin_theta[nonzero]
-        force0 = (
-            coef[:, None]
-            * (cos_theta[:, None] * r21 * norm21inv[:, None] - r23 * norm23inv[:, None])
-            * norm21inv[:, None]
-        )
-        force2 = (
-            coef[:, None]
-            * (cos_theta[:, None] * r23 * norm23inv[:, None] - r21 * norm21inv[:, None])
-            * norm23inv[:, None]
+        safe_sin = torch.where(nonzero, sin_theta, torch.ones_like(sin_theta))
+        coef = torch.where(
+            nonzero, -2.0 * k0 * delta_theta / safe_sin, torch.zeros_like(sin_theta)
         )
+        # Unit vectors are shared by the forces on both end atoms
+        u21 = r21 * norm21inv[:, None]
+        u23 = r23 * norm23inv[:, None]
+        force0 = (coef * norm21inv)[:, None] * (cos_theta[:, None] * u21 - u23)
+        force2 = (coef * norm23inv)[:, None] * (cos_theta[:, None] * u23 - u21)
         force1 = -(force0 + force2)
 
     return pot, (force0, force1, force2)
 
 
+def _amber_torsion(phi, k0, phi0, per, explicit_forces=True):
+    angleDiff = per * phi - phi0
+    coeff = -per * k0 * torch.sin(angleDiff) if explicit_forces else None
+    return k0 * (1 + torch.cos(angleDiff)), coeff
+
+
+def _amber_torsion_powers(cosPhi, sinPhi, tp, k0, per, explicit_forces=True):
+    # AMBER torsions with integer periodicities without atan2, cos or sin: cos and sin of n * phi follow from those of
+    # phi by angle addition, and those of per * phi - phi0 from the precomputed cos and sin of phi0
+    # Collinear atoms give cosPhi = sinPhi = 0, for which phi = 0 like atan2(0, 0)
+    norm2 = cosPhi * cosPhi + sinPhi * sinPhi
+    degenerate = norm2 == 0
+    rnorm = torch.rsqrt(norm2.masked_fill(degenerate, 1))
+    cos1 = (cosPhi * rnorm).masked_fill(degenerate, 1)
+    sin1 = -sinPhi * rnorm  # phi = -atan2(sinPhi, cosPhi)
+    cos_n, sin_n = [cos1], [sin1]
+    for _ in range(1, tp["max_per"]):
+        cos_n.append(cos_n[-1] * cos1 - sin_n[-1] * sin1)
+        sin_n.append(sin_n[-1] * cos1 + cos_n[-2] * sin1)
+    cos_n = torch.stack(cos_n)[tp["per_idx"], tp["idx"]]
+    sin_n = torch.stack(sin_n)[tp["per_idx"], tp["idx"]]
+
+    cos_diff = cos_n * tp["cos_phi0"] + sin_n * tp["sin_phi0"]
+    coeff = None
+    if explicit_forces:
+        sin_diff = sin_n * tp["cos_phi0"] - cos_n * tp["sin_phi0"]
+        coeff = -per * k0 * sin_diff
+    return k0 * (1 + cos_diff), coeff
+
+
+def _charmm_torsion(phi, k0, phi0, explicit_forces=True):
+    # Wrap into [-pi, pi] the same way wrap_dist wraps distances into the box
+    angleDiff = phi - phi0
+    angleDiff = angleDiff - 2 * pi * torch.round(angleDiff / (2 * pi))
+    coeff = 2 * k0 * angleDiff if explicit_forces else None
+    return k0 * angleDiff ** 2, coeff
+
+
 def evaluate_torsion(r12, r23, r34, torsion_params, explicit_forces=True):
-    # Calculate dihedral angles from vectors
+    # Calculate dihedral angles from vectors. atan2 only needs sinPhi and cosPhi up to a common positive factor and
+    # |crossC| = |r23| |crossA| as r23 is perpendicular to crossA, so neither crossA nor crossB is normalized.
+    # For collinear atoms the dihedral is undefined, the zero norms are replaced by 1 so that such torsions are
+    # evaluated at phi = 0 with finite forces instead of dividing 0 by 0
     crossA = torch.cross(r12, r23, dim=1)
     crossB = torch.cross(r23, r34, dim=1)
     crossC = torch.cross(r23, crossA, dim=1)
-    normA = torch.norm(crossA, dim=1)
-    normB = torch.norm(crossB, dim=1)
-    normC = torch.norm(crossC, dim=1)
-    normcrossB = crossB / normB.unsqueeze(1)
-    cosPhi = torch.sum(crossA * normcrossB, dim=1) / normA
-    sinPhi = torch.sum(crossC * normcrossB, dim=1) / normC
-    phi = -torch.atan2(sinPhi, cosPhi)
-
-    ntorsions = len(torsion_params[0]["idx"])
+    norm2Delta2 = torch.sum(r23 * r23, dim=1)
+    norm2Delta2 = norm2Delta2.masked_fill(norm2Delta2 == 0, 1)
+    normDelta2 = torch.sqrt(norm2Delta2)
+    cosPhi = torch.sum(crossA * crossB, dim=1)
+    sinPhi = torch.sum(crossC * crossB, dim=1) / normDelta2
+    phi = None
+
+    ntorsions = r12.shape[0]
     pot = torch.zeros(ntorsions, dtype=r12.dtype, layout=r12.layout, device=r12.device)
     if explicit_forces:
         coeff = torch.zeros(
             ntorsions, dtype=r12.dtype, layout=r12.layout, device=r12.device
         )
-    for i in range(0, len(torsion_params)):
-        idx = torsion_params[i]["idx"]
-        k0 = torsion_params[i]["params"][:, 0]
-        phi0 = torsion_params[i]["params"][:, 1]
-        per = torsion_params[i]["params"][:, 2]
-
-        if torch.all(per > 0):  # AMBER torsions
-            angleDiff = per * phi[idx] - phi0
-            pot.scatter_add_(0, idx, k0 * (1 + torch.cos(angleDiff)))
-            if explicit_forces:
-                coeff.scatter_add_(0, idx, -per * k0 * torch.sin(angleDiff))
-        else:  # CHARMM torsions
-            angleDiff = phi[idx] - phi0
-            angleDiff[angleDiff < -pi] = angleDiff[angleDiff < -pi] + 2 * pi
-            angleDiff[angleDiff > pi] = angleDiff[angleDiff > pi] - 2 * pi
-            pot.scatter_add_(0, idx, k0 * angleDiff ** 2)
+    for tp in torsion_params:
+        idx = tp["idx"]
+        k0 = tp["params"][:, 0]
+        phi0 = tp["params"][:, 1]
+        per = tp["params"][:, 2]
+        if "max_per" in tp:
+            E, c = _amber_torsion_powers(cosPhi, sinPhi, tp, k0, per, explicit_forces)
+            pot.scatter_add_(0, idx, E)
             if explicit_forces:
-                coeff.scatter_add_(0, idx, 2 * k0 * angleDiff)
+                coeff.scatter_add_(0, idx, c)
+            continue
+
+        if phi is None:
+            phi = -torch.atan2(sinPhi, cosPhi)
+        phi_idx = phi[idx]
+        amber = tp.get("amber")
+        if amber is None:
+            amber = bool(torch.all(per > 0))
+        if isinstance(amber, torch.Tensor):  # Mixed terms, each one picks its own form
+            E_amber, c_amber = _amber_torsion(phi_idx, k0, phi0, per, explicit_forces)
+            E_charmm, c_charmm = _charmm_torsion(phi_idx, k0, phi0, explicit_forces)
+            E = torch.where(amber, E_amber, E_charmm)
+            c = torch.where(amber, c_amber, c_charmm) if explicit_forces else None
+        elif amber:
+            E, c = _amber_torsion(phi_idx, k0, phi0, per, explicit_forces)
+        else:
+            E, c = _charmm_torsion(phi_idx, k0, phi0, explicit_forces)
+        pot.scatter_add_(0, idx, E)
+        if explicit_forces:
+            coeff.scatter_add_(0, idx, c)
 
     # coeff.unsqueeze_(1)
 
     force0, force1, force2, force3 = None, None, None, None
     if explicit_forces:
         # Taken from OpenMM
-        normDelta2 = torch.norm(r23, dim=1)
-        norm2Delta2 = normDelta2 ** 2
-        forceFactor0 = (-coeff * normDelta2) / (normA ** 2)
+        norm2A = torch.sum(crossA * crossA, dim=1)
+        norm2A = norm2A.masked_fill(norm2A == 0, 1)
+        norm2B = torch.sum(crossB * crossB, dim=1)
+        norm2B = norm2B.masked_fill(norm2B == 0, 1)
+        forceFactor0 = (-coeff * normDelta2) / norm2A
         forceFactor1 = torch.sum(r12 * r23, dim=1) / norm2Delta2
         forceFactor2 = torch.sum(r34 * r23, dim=1) / norm2Delta2
-        forceFactor3 = (coeff * normDelta2) / (normB ** 2)
+        forceFactor3 = (coeff * normDelta2) / norm2B
 
         force0vec = forceFactor0.unsqueeze(1) * crossA
         force3vec = forceFactor3.unsqueeze(1) * crossB
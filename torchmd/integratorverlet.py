@@ -1,4 +1,3 @@
-import numpy as np
 import torch
 
 TIMEFACTOR = 48.88821
@@ -72,6 +71,7 @@ class Integrator:
                 langevin(s.vel, self.gamma, self.vcoeff, self.dt, self.device)
             _second_VV(s.vel, s.forces, masses, self.dt)
 
-        Ekin = np.array([v.item() for v in kinetic_energy(masses, s.vel)])
+        # Single copy of the kinetic energies of all replicas to the host
+        Ekin = kinetic_energy(masses, s.vel).detach().cpu().double().numpy().reshape(-1)
         T = kinetic_to_temp(Ekin, natoms)
         return Ekin, pot, T
@@ -1,4 +1,5 @@
 import torch
+from torchmd.pbc import calculate_distances, inverse_box, wrap_dist
 
 
 def discretize_box(box, subcell_size):
@@ -31,17 +32,102 @@ def discretize_box(box, subcell_size):
     return xbins, ybins, zbins, cellneighbours
 
 
-# def neighbour_list(pos, box, subcell_size):
-#     nsystems = coordinates.shape[0]
+class CellList:
+    """
+    Cell-list (spatial hash) neighbour search which only emits the unique, non-excluded atom pairs
+    within a given distance instead of enumerating all pairs.
 
-#     for s in range(nsystems):
-#         spos = pos[s]
-#         sbox = box[s]
+    Parameters
+    ----------
+    natoms : int
+        Number of atoms in the system
+    exclusions : list
+        Pairs of atom indexes which should never be returned as neighbours
+    device : str or torch.device
+        Device on which the exclusion table is stored
+    """
 
-#         xbins, ybins, zbins = discretize_box(sbox, subcell_size)
+    def __init__(self, natoms, exclusions, device):
+        self.natoms = natoms
+        # Cell offsets along each dimension, created once instead of at every rebuild
+        self.cell_shifts = torch.tensor([-1, 0, 1], device=device)
+        self.excl_keys = None
+        if len(exclusions):
+            excl = torch.sort(torch.tensor(exclusions, dtype=torch.long), dim=1)[0]
+            self.excl_keys = torch.unique(excl[:, 0] * natoms + excl[:, 1]).to(device)
 
-#         xidx = torch.bucketize(spos[:, 0], xbins, out_int32=True)
-#         yidx = torch.bucketize(spos[:, 1], ybins, out_int32=True)
-#         zidx = torch.bucketize(spos[:, 2], zbins, out_int32=True)
+    def build(self, pos, box, cutoff, delt_r=0):
+        """Returns the pairs closer than `cutoff + delt_r` together with their distances and unit vectors"""
+        natoms = pos.shape[0]
+        device = pos.device
+        cell_size = cutoff + delt_r
+        ppos = pos.detach()
 
-#         binidx = torch.stack((xidx, yidx, zidx)).T
+        # Dimensions with a zero box length are not periodic, their cells span the extent of the atoms instead
+        sbox = torch.zeros(3, device=device, dtype=ppos.dtype) if box is None else box
+        periodic = sbox > 0
+        ppos = ppos - sbox * torch.floor(ppos * inverse_box(sbox))  # Wrap into [0, box)
+        origin = torch.where(periodic, torch.zeros_like(sbox), ppos.min(dim=0)[0])
+        extent = ppos.max(dim=0)[0] - origin
+        ncells = torch.where(
+            periodic,
+            torch.clamp(torch.floor(sbox / cell_size), min=1),
+            torch.floor(extent / cell_size) + 1,
+        ).long()
+        cell_len = torch.where(
+            periodic, sbox / ncells, torch.full_like(sbox, cell_size)
+        )
+        binned = torch.floor((ppos - origin) / cell_len).long()
+        binned = torch.min(binned, ncells - 1)
+
+        # With less than 3 cells along a periodic dimension the -1 and +1 neighbours are the same cell
+        r = self.cell_shifts.to(device)
+        axes = [
+            r if n >= 3 or not p else r[1 : 1 + n]
+            for n, p in zip(ncells.tolist(), periodic.tolist())
+        ]
+        offsets = torch.cartesian_prod(*axes)
+
+        # Sort atoms by the linear hash of their cell
+        hashes = (binned[:, 0] * ncells[1] + binned[:, 1]) * ncells[2] + binned[:, 2]
+        order = torch.argsort(hashes)
+        sorted_hashes = hashes[order]
+
+        # Hashes of the neighbouring cells of every atom
+        neigh = binned.unsqueeze(1) + offsets.unsqueeze(0)
+        neigh = torch.where(periodic, torch.remainder(neigh, ncells), neigh)
+        neigh_hashes = (neigh[:, :, 0] * ncells[1] + neigh[:, :, 1]) * ncells[2] + neigh[:, :, 2]
+        # Cells beyond the extent of a non-periodic dimension hold no atoms
+        outside = torch.any((neigh < 0) | (neigh >= ncells), dim=2)
+        neigh_hashes[outside] = -1
+        neigh_hashes = neigh_hashes.flatten()
+
+        # Atoms of each neighbouring cell are a contiguous range of the sorted hashes
+        start = torch.searchsorted(sorted_hashes, neigh_hashes)
+        counts = torch.searchsorted(sorted_hashes, neigh_hashes, right=True) - start
+        idx_i = torch.arange(natoms, device=device).repeat_interleave(offsets.shape[0])
+        idx_i = idx_i.repeat_interleave(counts)
+        first = torch.cumsum(counts, 0) - counts
+        slot = torch.arange(int(counts.sum()), device=device) + (start - first).repeat_interleave(counts)
+        idx_j = order[slot]
+
+        # Keep every pair once and drop the excluded ones
+        keep = idx_i < idx_j
+        idx_i = idx_i[keep]
+        idx_j = idx_j[keep]
+        if self.excl_keys is not None:
+            keys = idx_i * self.natoms + idx_j
+            loc = torch.searchsorted(self.excl_keys, keys)
+            loc = torch.clamp(loc, max=len(self.excl_keys) - 1)
+            keep = self.excl_keys[loc] != keys
+            idx_i = idx_i[keep]
+            idx_j = idx_j[keep]
+
+        # Coarse test on the squared distances so that the full geometry is only computed for the pairs in range
+        vec = wrap_dist(ppos[idx_i] - ppos[idx_j], box)
+        within = torch.sum(vec * vec, dim=1) <= cell_size ** 2
+
+        # Pairs are stored column-major so that pairs[:, 0] and pairs[:, 1] are contiguous
+        pairs = torch.stack((idx_i[within], idx_j[within])).to(torch.int32).T
+        dist, unitvec, _ = calculate_distances(pos, pairs, box)
+        return pairs, dist, unitvec
@@ -0,0 +1,32 @@
+import torch
+
+
+def inverse_box(box):
+    # Reciprocal box lengths, dimensions with a zero box length get 1 so that wrap_dist leaves them unwrapped
+    return 1 / box.masked_fill(box == 0, 1)
+
+
+def wrap_dist(dist, box, inv_box=None):
+    # `box` is either a single box diagonal or one per distance vector, `inv_box` optionally its inverse_box.
+    # Dimensions with a zero box length are not wrapped, which is decided on the device so that no host
+    # synchronization is needed
+    if box is None:
+        return dist
+    if inv_box is None:
+        inv_box = inverse_box(box)
+    if box.dim() == 1:
+        box = box.unsqueeze(0)
+        inv_box = inv_box.unsqueeze(0)
+    return dist - box * torch.round(dist * inv_box)
+
+
+def calculate_distances(atom_pos, atom_idx, box, inv_box=None):
+    # Both atoms of every pair are gathered at once through the (2, npairs) view of the column-major pairs
+    pair_pos = atom_pos.index_select(0, atom_idx.T.reshape(-1)).view(2, -1, 3)
+    direction_vec = wrap_dist(pair_pos[0] - pair_pos[1], box, inv_box)
+    # One reciprocal square root per pair gives both the distance and the unit vector without any division
+    dist2 = torch.sum(direction_vec * direction_vec, dim=1)
+    rinv = torch.rsqrt(dist2)
+    dist = dist2 * rinv
+    direction_unitvec = direction_vec * rinv.unsqueeze(1)
+    return dist, direction_unitvec, direction_vec
@@ -126,7 +126,7 @@ def dynamics(args, mol, system, forces):
         logs.append(LogWriter(args.log_dir,keys=('iter','ns','epot','ekin','etot','T'), name=f'monitor_{k}.csv'))
         trajs.append([])
 
-    if args.minimize != None:
+    if args.minimize is not None:
         minimize_bfgs(system, forces, steps=args.minimize)
 
     iterator = tqdm(range(1,int(args.steps/args.output_period)+1))